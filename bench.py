@@ -0,0 +1,579 @@
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import Counter
+from datetime import timedelta
+
+from aiohttp import web
+from telegram import KeyboardButton, ReplyKeyboardMarkup, TelegramObject, Update
+from telegram.error import Forbidden, NetworkError, RetryAfter
+from telegram.ext import ApplicationBuilder
+
+import main
+from main import MAIN_MENU, REPLY_WORKOUT_STARTED, UserLaneUpdateProcessor
+
+RESULTS_PATH = "bench_results.jsonl"
+
+# Лог каждого HTTP-запроса исказил бы замеры
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# ==================== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ====================
+def make_text_update(update_id: int, user_id: int, text: str, bot=None) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text
+        }
+    }, bot)
+
+def make_callback_update(update_id: int, user_id: int, data: str, bot=None) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                "text": "📊"
+            }
+        }
+    }, bot)
+
+# Сценарии пользователя: шаги (вид, текст); None — свободный текст
+SCRIPTS = {
+    "mindful_note": [("tap", "✨ Я осознан!"), ("tap", "📝 Записать заметку"), ("note", None)],
+    "mindful_skip": [("tap", "✨ Я осознан!"), ("tap", "📝 Записать заметку"), ("tap", "❌ Пропустить заметку")],
+    "workout": [("tap", "⏱ Начать тренировку"), ("tap", "❌ Отменить"), ("tap", "🏁 Закончить тренировку"),
+                ("tap", "📝 Записать заметку"), ("note", None)],
+    "task": [("tap", "💡 Задание")],
+    "reflection": [("tap", "📅 Рефлексия")],
+    "stats": [("tap", "📊 Статистика"), ("tap", "📊 Статистика по осознанности"), ("stats_period", "📆 За неделю")],
+    "ai": [("tap", "🧠 Поговорить с ИИ"), ("ai", None)]
+}
+SCRIPT_WEIGHTS = {"mindful_note": 30, "mindful_skip": 15, "workout": 10, "task": 10, "reflection": 5,
+                  "stats": 20, "ai": 10}
+NOTES = ["Заметил дыхание", "Спокойно", "Пил чай без телефона", "Почувствовал усталость", "Прогулка"]
+AI_PROMPTS = [f"Как справиться с тревогой перед задачей №{i}?" for i in range(20)]
+
+def percentile(samples, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def latency_summary(latencies: dict) -> dict:
+    # latencies: вид шага -> [секунды]; миллисекунды по всем шагам и по каждому виду
+    summary = {}
+    everything = [x for samples in latencies.values() for x in samples]
+    for kind, samples in [("all", everything)] + sorted(latencies.items()):
+        summary[f"{kind}_p50_ms"] = round(percentile(samples, 50) * 1000, 2)
+        summary[f"{kind}_p99_ms"] = round(percentile(samples, 99) * 1000, 2)
+    return summary
+
+# ==================== ФЕЙКОВЫЕ СЕРВИСЫ ====================
+class FakeBot:
+    # Офлайн-заглушка бота для Broadcaster: задержка, заблокировавшие бота чаты,
+    # периодический флуд-контроль и чаты, первая отправка в которые рвёт сеть
+    def __init__(self, latency: float = 0.0, blocked_chats=(), flood_every: int = 0, retry_after: float = 1,
+                 flaky_chats=()):
+        self.latency = latency
+        self.blocked_chats = set(blocked_chats)
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.flaky_chats = set(flaky_chats)
+        self.calls = 0
+        self.floods = []  # monotonic-время каждого RetryAfter
+        self.sent = []  # (chat_id, text, kwargs, monotonic-время)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        call = self.calls
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if chat_id in self.blocked_chats:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if self.flood_every and call % self.flood_every == 0:
+            self.floods.append(time.monotonic())
+            raise RetryAfter(self.retry_after)
+        if chat_id in self.flaky_chats:
+            self.flaky_chats.discard(chat_id)
+            raise NetworkError("Connection reset by peer")
+        self.sent.append((chat_id, text, kwargs, time.monotonic()))
+
+class FakeBotAPI:
+    # Bot API на локальном aiohttp-сервере: отвечает как Telegram, с задержкой latency
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()  # метод -> количество
+        self._message_id = 0
+        self._runner = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([web.post("/bot{token}/{method}", self.handle)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+        if method == "getUpdates":
+            # Долгий опрос без новых обновлений: держим запрос, но не дольше секунды
+            await asyncio.sleep(min(float(params.get("timeout", 0)), 1.0))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return []
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            self._message_id += 1
+            return {
+                "message_id": int(params.get("message_id", self._message_id)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")
+            }
+        return True
+
+class MockYandexGPT:
+    # Ответ YandexGPT за latency секунд; в потоковом режиме — chunks строк с накопленным текстом
+    ANSWER = "Сделай три медленных вдоха, заметь, что чувствует тело, и назови одну вещь, которая сейчас под контролем."
+
+    def __init__(self, latency: float = 0.5, chunks: int = 4):
+        self.latency = latency
+        self.chunks = chunks
+        self.requests = 0
+        self._runner = None
+        self.port = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/completion"
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([web.post("/completion", self.handle)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    @staticmethod
+    def _chunk(text: str) -> dict:
+        return {"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}}
+
+    async def handle(self, request):
+        payload = await request.json()
+        self.requests += 1
+        if not payload["completionOptions"].get("stream"):
+            await asyncio.sleep(self.latency)
+            return web.json_response(self._chunk(self.ANSWER))
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        words = self.ANSWER.split()
+        for i in range(1, self.chunks + 1):
+            await asyncio.sleep(self.latency / self.chunks)
+            text = " ".join(words[:len(words) * i // self.chunks])
+            await resp.write((json.dumps(self._chunk(text), ensure_ascii=False) + "\n").encode("utf-8"))
+        await resp.write_eof()
+        return resp
+
+class BotHarness:
+    # Настоящий Application из main.py поверх фейкового Bot API и мока YandexGPT
+    # со свежими хранилищем, кешем ИИ и рассыльщиком на каждый сценарий
+    def __init__(self, api_latency: float, ai_latency: float, storage_backend: str, broadcast_rate: float):
+        self.api = FakeBotAPI(api_latency)
+        self.ai = MockYandexGPT(ai_latency)
+        self.storage_backend = storage_backend
+        self.broadcast_rate = broadcast_rate
+        self.application = None
+        self._update_id = 0
+        self._tmpdir = None
+
+    async def __aenter__(self):
+        await self.api.start()
+        await self.ai.start()
+        self.application = (
+            ApplicationBuilder()
+            .token("123:BENCH")
+            .base_url(self.api.base_url)
+            .concurrent_updates(UserLaneUpdateProcessor())
+            .request(main.InstrumentedRequest(connection_pool_size=256))
+            .updater(None)
+            .build()
+        )
+        main.register_handlers(self.application)
+        await self.application.initialize()
+
+        if self.storage_backend == "sqlite":
+            self._tmpdir = tempfile.TemporaryDirectory()
+            backend = main.SQLiteBackend(os.path.join(self._tmpdir.name, "bench.sqlite3"), main.STORAGE_FLUSH_BATCH)
+        else:
+            backend = main.MemoryBackend()
+        main.storage = main.DataStorage()
+        main.storage.open(backend)
+        main.ai_cache = main.AIResponseCache()
+        main.broadcaster = main.Broadcaster(self.application.bot, rate=self.broadcast_rate, per_chat_interval=0)
+        main.YC_API_KEY = main.YC_FOLDER_ID = "bench"
+        main.ai_client = main.YandexGPTClient(url=self.ai.url)
+        await main.ai_client.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await main.ai_client.close()
+        await self.application.shutdown()
+        main.storage.close()
+        await self.ai.close()
+        await self.api.close()
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+    def text_update(self, user_id: int, text: str) -> Update:
+        self._update_id += 1
+        return make_text_update(self._update_id, user_id, text, self.application.bot)
+
+    def callback_update(self, user_id: int, data: str) -> Update:
+        self._update_id += 1
+        return make_callback_update(self._update_id, user_id, data, self.application.bot)
+
+    async def process(self, update: Update) -> float:
+        # Путь как у задачи UpdateIngress: полоса пользователя, затем обработчики PTB
+        started = time.perf_counter()
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        return time.perf_counter() - started
+
+async def simulate_users(harness: BotHarness, users: int, scripts_per_user: int, think_time: float) -> dict:
+    # Пользователи действуют параллельно, каждый ждёт ответа перед следующим нажатием
+    latencies = {}
+    rng = random.Random(42)
+    names, weights = zip(*SCRIPT_WEIGHTS.items())
+
+    async def user(user_id: int):
+        for name in rng.choices(names, weights, k=scripts_per_user):
+            for kind, text in SCRIPTS[name]:
+                if text is None:
+                    text = rng.choice(AI_PROMPTS) if kind == "ai" else f"{rng.choice(NOTES)} #{user_id}"
+                latencies.setdefault(kind, []).append(await harness.process(harness.text_update(user_id, text)))
+                if think_time:
+                    await asyncio.sleep(rng.uniform(0, think_time))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(user_id) for user_id in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(samples) for samples in latencies.values())
+    return {
+        "users": users,
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(updates / elapsed),
+        **latency_summary(latencies),
+        "bot_api_calls": sum(harness.api.calls.values()),
+        "ai_requests": harness.ai.requests
+    }
+
+def storage_allocated_bytes() -> int:
+    # Память, выделенная в строках классов хранилища (по данным tracemalloc)
+    ranges = []
+    for cls in (main.SessionSeries, main.ActivityCounters, main.DataStorage):
+        lines, first = inspect.getsourcelines(cls)
+        ranges.append((first, first + len(lines)))
+    total = 0
+    for stat in tracemalloc.take_snapshot().statistics("lineno"):
+        frame = stat.traceback[0]
+        if frame.filename == main.__file__ and any(lo <= frame.lineno < hi for lo, hi in ranges):
+            total += stat.size
+    return total
+
+# ==================== СЦЕНАРИИ ====================
+async def bench_user_lanes(users: int, updates_per_user: int, handler_latency: float, concurrency: int) -> dict:
+    # Пропускная способность полос и проверка порядка: у каждого пользователя
+    # обновления должны завершиться в порядке update_id
+    processor = UserLaneUpdateProcessor(concurrency)
+    finished = {}  # user_id -> [update_id, ...]
+
+    async def handler(update: Update):
+        await asyncio.sleep(handler_latency * random.uniform(0.5, 1.5))
+        finished.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    updates = [
+        make_text_update(i * users + user_id, user_id, "✨ Я осознан!")
+        for i in range(updates_per_user)
+        for user_id in range(1, users + 1)
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(*(processor.process_update(u, handler(u)) for u in updates))
+    elapsed = time.perf_counter() - started
+
+    ordered = all(ids == sorted(ids) for ids in finished.values())
+    return {
+        "scenario": "user_lanes",
+        "users": users,
+        "updates": len(updates),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed),
+        "serial_estimate_seconds": round(len(updates) * handler_latency, 1),
+        "per_user_order_kept": ordered,
+        "peak_lanes": processor.peak_lanes,
+        "lanes_left": processor.active_lanes
+    }
+
+def encode_parameter(value) -> str:
+    # Как PTB готовит параметр запроса: объекты — через to_dict и json.dumps, строки — как есть
+    if isinstance(value, TelegramObject):
+        return json.dumps(value.to_dict())
+    return value
+
+def bench_keyboards(iterations: int) -> dict:
+    # Цена разметки на одно исходящее сообщение: сборка и JSON-кодирование каждый раз
+    # против готовой строки, которую PTB передаёт без кодирования
+    def build_each_time():
+        markup = ReplyKeyboardMarkup([
+            [KeyboardButton("💡 Задание"), KeyboardButton("📅 Рефлексия")],
+            [KeyboardButton("✨ Я осознан!")],
+            [KeyboardButton("⏱ Начать тренировку"), KeyboardButton("🏁 Закончить тренировку")],
+            [KeyboardButton("🧠 Поговорить с ИИ")],
+            [KeyboardButton("📊 Статистика")]
+        ], resize_keyboard=True)
+        return encode_parameter(markup)
+
+    def cached():
+        return encode_parameter(MAIN_MENU)
+
+    def format_each_time():
+        return f"✅ Тренировка начата в {'18:30'}!"
+
+    def template():
+        return REPLY_WORKOUT_STARTED.render(time="18:30")
+
+    before = timeit.timeit(build_each_time, number=iterations)
+    after = timeit.timeit(cached, number=iterations)
+    return {
+        "scenario": "keyboards",
+        "iterations": iterations,
+        "build_and_encode_us": round(before / iterations * 1e6, 2),
+        "cached_us": round(after / iterations * 1e6, 2),
+        "speedup": round(before / after, 1),
+        "markup_bytes_before": len(build_each_time().encode("utf-8")),
+        "markup_bytes_after": len(cached().encode("utf-8")),
+        "fstring_us": round(timeit.timeit(format_each_time, number=iterations) / iterations * 1e6, 3),
+        "template_us": round(timeit.timeit(template, number=iterations) / iterations * 1e6, 3)
+    }
+
+async def bench_load(args) -> dict:
+    # Смешанный поток нажатий, заметок, запросов к ИИ и статистики через весь стек бота
+    async with BotHarness(args.api_latency, args.ai_latency, args.storage, args.broadcast_rate) as harness:
+        result = await simulate_users(harness, args.users, args.scripts_per_user, args.think_time)
+    return {"scenario": "load", "storage": args.storage, **result}
+
+async def bench_memory(args) -> dict:
+    # Тот же поток под tracemalloc: рост памяти хранилища на одну записанную сессию.
+    # Трассировка замедляет код — пропускную способность смотрите в сценарии load
+    async with BotHarness(0, 0, args.storage, args.broadcast_rate) as harness:
+        tracemalloc.start()
+        before = storage_allocated_bytes()
+        result = await simulate_users(harness, args.users, args.scripts_per_user, 0)
+        main.storage.backend.flush()
+        grown = storage_allocated_bytes() - before
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        sessions = sum(map(len, main.storage.mindfulness_sessions.values())) + \
+            sum(map(len, main.storage.fitness_sessions.values()))
+    return {
+        "scenario": "memory",
+        "storage": args.storage,
+        "users": args.users,
+        "sessions": sessions,
+        "storage_bytes_growth": grown,
+        "bytes_per_session": round(grown / sessions, 1) if sessions else 0,
+        "traced_peak_bytes": peak
+    }
+
+async def bench_stats_history(args) -> dict:
+    # handle_stat_period и листание на длинной истории: history сессий за год у каждого пользователя
+    async with BotHarness(0, 0, args.storage, args.broadcast_rate) as harness:
+        now = main.now_moscow()
+        started = time.perf_counter()
+        for user_id in range(1, args.stats_users + 1):
+            for i in range(args.history, 0, -1):
+                main.storage.add_session("mindfulness", user_id, {
+                    "time": now - timedelta(seconds=i * 365 * 86400 // args.history),
+                    "note": f"Заметка {i} — _разметка_ и *звёздочки*"
+                })
+        main.storage.backend.flush()
+        load_seconds = time.perf_counter() - started
+
+        today = main.ActivityCounters.day_of(now)
+        latencies = {}
+        for user_id in range(1, args.stats_users + 1):
+            for text in ("📊 Статистика", "📊 Статистика по осознанности"):
+                await harness.process(harness.text_update(user_id, text))
+            latencies.setdefault("stats_period", []).append(
+                await harness.process(harness.text_update(user_id, "📆 За неделю"))
+            )
+            for page in range(1, 6):
+                data = f"stats:mindfulness:{today - main.ActivityCounters.KEEP_DAYS + 1}:{today}:{page}"
+                latencies.setdefault("stats_page", []).append(
+                    await harness.process(harness.callback_update(user_id, data))
+                )
+    return {
+        "scenario": "stats_history",
+        "storage": args.storage,
+        "users": args.stats_users,
+        "history_per_user": args.history,
+        "load_seconds": round(load_seconds, 3),
+        **latency_summary(latencies)
+    }
+
+async def bench_daily_report(args) -> dict:
+    # Полный проход send_daily_report по report_users активным сегодня пользователям
+    async with BotHarness(args.api_latency, 0, args.storage, args.broadcast_rate) as harness:
+        now = main.now_moscow()
+        for user_id in range(1, args.report_users + 1):
+            main.storage.add_session("mindfulness", user_id, {"time": now, "note": "Без заметки"})
+            if user_id % 3 == 0:
+                main.storage.add_session("fitness", user_id, {"time": now, "note": "Бег", "duration_seconds": 1800})
+        report = await main.send_daily_report()
+    return {
+        "scenario": "daily_report",
+        "users": args.report_users,
+        "sent": report.sent,
+        "failed": report.failed,
+        "seconds": round(report.elapsed, 3),
+        "messages_per_second": round(report.sent / report.elapsed) if report.elapsed else 0,
+        "broadcast_rate_limit": args.broadcast_rate
+    }
+
+async def bench_broadcast(args) -> dict:
+    # Рассыльщик против заглушки бота: каждый 50-й чат заблокирован, каждый 40-й
+    # теряет первую отправку, флуд-контроль раз в 1000 вызовов
+    users = range(1, args.report_users + 1)
+    bot = FakeBot(args.api_latency, blocked_chats=users[49::50], flood_every=1000,
+                  flaky_chats=users[39::40])
+    broadcaster = main.Broadcaster(bot, rate=args.broadcast_rate)
+    report = await broadcaster.broadcast(((user_id, "📨") for user_id in users), name="Бенчмарк")
+    return {
+        "scenario": "broadcast",
+        "users": args.report_users,
+        "sent": report.sent,
+        "failed": report.failed,
+        "retries": report.retries,
+        "floods": len(bot.floods),
+        "seconds": round(report.elapsed, 3),
+        "messages_per_second": round(report.sent / report.elapsed) if report.elapsed else 0,
+        "broadcast_rate_limit": args.broadcast_rate
+    }
+
+# ==================== РЕЗУЛЬТАТЫ ====================
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def previous_result(path: str, scenario: str, commit: str):
+    # Последний сохранённый результат того же сценария с другого коммита
+    if not os.path.exists(path):
+        return None
+    found = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["result"].get("scenario") == scenario and record["commit"] != commit:
+                found = record
+    return found
+
+def save_result(path: str, commit: str, args, result: dict):
+    record = {"commit": commit, "time": int(time.time()), "args": vars(args), "result": result}
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+# ==================== ЗАПУСК ====================
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочные замеры бота")
+    parser.add_argument("--scenario", default="all",
+                        choices=["all", "lanes", "keyboards", "load", "memory", "stats_history", "daily_report",
+                                 "broadcast"])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates-per-user", type=int, default=5)
+    parser.add_argument("--handler-latency", type=float, default=0.005)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--scripts-per-user", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument("--api-latency", type=float, default=0.01, help="задержка фейкового Bot API, с")
+    parser.add_argument("--ai-latency", type=float, default=0.3, help="задержка мока YandexGPT, с")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--stats-users", type=int, default=20)
+    parser.add_argument("--history", type=int, default=20000, help="сессий в истории каждого пользователя")
+    parser.add_argument("--report-users", type=int, default=5000)
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="лимит рассыльщика, сообщений/с")
+    parser.add_argument("--results", default=RESULTS_PATH, help="файл истории результатов (JSON Lines)")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    scenarios = {
+        "lanes": lambda: asyncio.run(
+            bench_user_lanes(args.users, args.updates_per_user, args.handler_latency, args.concurrency)
+        ),
+        "keyboards": lambda: bench_keyboards(args.iterations),
+        "load": lambda: asyncio.run(bench_load(args)),
+        "memory": lambda: asyncio.run(bench_memory(args)),
+        "stats_history": lambda: asyncio.run(bench_stats_history(args)),
+        "daily_report": lambda: asyncio.run(bench_daily_report(args)),
+        "broadcast": lambda: asyncio.run(bench_broadcast(args))
+    }
+    commit = current_commit()
+    for name, run in scenarios.items():
+        if args.scenario not in ("all", name):
+            continue
+        result = run()
+        previous = previous_result(args.results, result["scenario"], commit)
+        print(f"commit: {commit}")
+        for key, value in result.items():
+            before = previous["result"].get(key) if previous else None
+            suffix = f"  (было {before} на {previous['commit']})" if before is not None and before != value else ""
+            print(f"{key}: {value}{suffix}")
+        print()
+        if not args.no_save:
+            save_result(args.results, commit, args, result)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,12 @@
+# Корень репозитория попадает в sys.path вместе с этим файлом: тесты импортируют main и bench
+# и при запуске просто `pytest`
+import pytest
+
+import main
+
+
+@pytest.fixture
+def storage() -> main.DataStorage:
+    storage = main.DataStorage()
+    storage.open(main.MemoryBackend())
+    return storage
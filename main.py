@@ -1,26 +1,118 @@
 import os
 import logging
 import random
+import secrets
+import argparse
 import asyncio
-from datetime import datetime, timedelta
+import csv
+import hashlib
+import heapq
+import io
+import json
+import pickle
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+from datetime import date, datetime, timedelta
+from enum import Enum
+from functools import partial
+from string import Formatter
 from zoneinfo import ZoneInfo
-from aiohttp import web, ClientSession
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+from aiohttp import (
+    web, ClientError, ClientOSError, ClientSession, ClientTimeout, ConnectionTimeoutError, TCPConnector
+)
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
 
 # ==================== КОНФИГУРАЦИЯ ====================
 BOT_TOKEN = "7276083736:AAGgMbHlOo5ccEvuUV-KXuJ0i2LQlgqEG_I"
 YC_API_KEY = os.getenv("YC_API_KEY")
 YC_FOLDER_ID = os.getenv("YC_FOLDER_ID")
-YC_API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+YC_API_URL = os.getenv("YC_API_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
 # Настройки времени
 AUTO_FINISH_HOURS = 3
-AUTO_FINISH_CHECK_SECONDS = 300
 DAILY_REPORT_HOUR = 23
 PORT = int(os.getenv("PORT", 10000))
 
+# Настройки статистики: страница из STATS_PAGE_SIZE записей с заметками не длиннее
+# STATS_NOTE_MAX_CHARS гарантированно укладывается в лимит Telegram в 4096 символов.
+# Telegram считает длину в единицах UTF-16: эмодзи вне BMP — это две единицы
+STATS_PAGE_SIZE = 10
+STATS_NOTE_MAX_CHARS = 300
+
+# Настройки хранилища
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | memory
+DB_PATH = os.getenv("DB_PATH", "chekamind.sqlite3")
+STORAGE_FLUSH_SECONDS = float(os.getenv("STORAGE_FLUSH_SECONDS", 2))
+STORAGE_FLUSH_BATCH = int(os.getenv("STORAGE_FLUSH_BATCH", 500))
+
+# Незавершённые диалоги: не больше USER_STATES_MAX, простой дольше USER_STATE_TTL_SECONDS сбрасывается
+USER_STATES_MAX = int(os.getenv("USER_STATES_MAX", 100000))
+USER_STATE_TTL_SECONDS = float(os.getenv("USER_STATE_TTL_SECONDS", 1800))
+
+# Остановка: незавершённой работе даётся SHUTDOWN_DEADLINE_SECONDS, затем снимок памяти
+# пишется в SNAPSHOT_PATH и поднимается при следующем запуске
+SHUTDOWN_DEADLINE_SECONDS = float(os.getenv("SHUTDOWN_DEADLINE_SECONDS", 20))
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "chekamind.snapshot")
+
+# Экспорт и импорт истории читаются и пишутся порциями по EXPORT_CHUNK_ROWS сессий
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 10000))
+
+# Настройки рассылок (лимиты Telegram: ~30 сообщений/сек на бота, ~1 в секунду на чат)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PROGRESS_EVERY = 1000
+
+# Настройки приёма обновлений: без WEBHOOK_URL бот работает через long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))  # принятых, но ещё не обработанных
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 256))
+
+# Настройки кластера: несколько процессов с общей базой SQLite (DB_PATH).
+# CLUSTER_NODES — "w0=http://127.0.0.1:10000,w1=http://127.0.0.1:10001"
+CLUSTER_NODE_ID = os.getenv("CLUSTER_NODE_ID")
+CLUSTER_NODES = os.getenv("CLUSTER_NODES", "")
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")  # обязателен: без него /cluster/update принял бы чужие обновления
+CLUSTER_LEASE_SECONDS = float(os.getenv("CLUSTER_LEASE_SECONDS", 15))
+CLUSTER_SYNC_SECONDS = float(os.getenv("CLUSTER_SYNC_SECONDS", 30))
+# Сколько ждать ответа узла-владельца: дольше таймаута ИИ, которого может ждать обработчик
+CLUSTER_FORWARD_TIMEOUT_SECONDS = float(os.getenv("CLUSTER_FORWARD_TIMEOUT_SECONDS", 60))
+
+# Настройки клиента YandexGPT
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", 8))
+AI_POOL_SIZE = int(os.getenv("AI_POOL_SIZE", 16))
+AI_TIMEOUT_SECONDS = float(os.getenv("AI_TIMEOUT_SECONDS", 15))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", 2))
+AI_RETRY_BASE_SECONDS = 0.5
+AI_DNS_CACHE_SECONDS = 300
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+AI_STREAM_EDIT_SECONDS = float(os.getenv("AI_STREAM_EDIT_SECONDS", 1.5))  # Telegram ограничивает частоту правок
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", 2000))
+AI_CACHE_MAX_BYTES = int(os.getenv("AI_CACHE_MAX_BYTES", 2 * 1024 * 1024))
+AI_CACHE_TTL_SECONDS = float(os.getenv("AI_CACHE_TTL_SECONDS", 6 * 3600))
+
+# Метрики Prometheus на /metrics; при METRICS_ENABLED=0 замеры не ведутся
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
 # Настройки логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,54 +120,1746 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== МЕТРИКИ ====================
+class Histogram:
+    # Гистограмма Prometheus с метками: замер — bisect и два сложения,
+    # накопительные суммы по корзинам считаются только при выдаче /metrics
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    __slots__ = ("name", "help", "labels", "buckets", "_series")
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # значения меток -> [счётчики по корзинам (+Inf последним), сумма]
+
+    def observe(self, seconds: float, *label_values):
+        if not METRICS_ENABLED:
+            return
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total) in self._series.items():
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+class CounterMetric:
+    __slots__ = ("name", "help", "labels", "_values")
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = Counter()  # значения меток -> количество
+
+    def inc(self, *label_values, amount: int = 1):
+        if METRICS_ENABLED:
+            self._values[label_values] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self._values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class GaugeMetric:
+    # Значение снимается функцией в момент запроса /metrics — на горячем пути ничего не стоит.
+    # blocking: функция ходит в базу, её значение заранее снимает collect() в потоке
+    __slots__ = ("name", "help", "read", "blocking", "value")
+
+    def __init__(self, name: str, help: str, read, blocking: bool = False):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.blocking = blocking
+        self.value = 0
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.value if self.blocking else self.read()}"
+
+def format_labels(names, values) -> str:
+    # Значения меток — имена маршрутов, методов и ошибок, экранирование не требуется
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name: str, help: str, labels=(), buckets=Histogram.BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def counter(self, name: str, help: str, labels=()) -> CounterMetric:
+        return self._register(CounterMetric(name, help, labels))
+
+    def gauge(self, name: str, help: str, read, blocking: bool = False) -> GaugeMetric:
+        return self._register(GaugeMetric(name, help, read, blocking))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Ошибка снятия метрики {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def collect(self) -> str:
+        for metric in self._metrics:
+            if isinstance(metric, GaugeMetric) and metric.blocking:
+                try:
+                    metric.value = await asyncio.to_thread(metric.read)
+                except Exception as e:
+                    logger.error(f"Ошибка снятия метрики {metric.name}: {e}")
+        return self.render()
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Время обработки сообщения по маршруту", ("route",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Исключения в обработчиках по маршруту", ("route",))
+TELEGRAM_SECONDS = metrics.histogram("bot_telegram_request_seconds", "Время запроса к Bot API", ("method",))
+TELEGRAM_ERRORS = metrics.counter(
+    "bot_telegram_errors_total", "Неуспешные запросы к Bot API (HTTP-статус или сетевая ошибка)", ("method", "code")
+)
+AI_SECONDS = metrics.histogram(
+    "bot_ai_request_seconds", "Время ответа YandexGPT", ("mode",), buckets=(0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+)
+AI_ERRORS = metrics.counter("bot_ai_errors_total", "Ошибки запросов к YandexGPT", ("error",))
+USER_STATE_EVICTIONS = metrics.counter(
+    "bot_user_state_evictions_total", "Сброшенные незавершённые диалоги (ttl — простой, lru — лимит)", ("reason",)
+)
+LOOP_TICK_SECONDS = metrics.histogram("bot_loop_tick_seconds", "Длительность итерации фоновых циклов", ("loop",))
+metrics.gauge("bot_active_workouts", "Незавершённые тренировки", lambda: len(storage.active_fitness_sessions),
+              blocking=True)
+metrics.gauge("bot_user_states", "Пользователи в середине диалога", lambda: len(storage.user_states), blocking=True)
+metrics.gauge("bot_scheduled_jobs", "Задачи в планировщике", lambda: len(scheduler))
+metrics.gauge("bot_ai_in_flight", "Запросы к YandexGPT в процессе", lambda: ai_client.in_flight)
+
+class InstrumentedRequest(HTTPXRequest):
+    # Замер каждого запроса бота к Bot API; метка — имя метода из конца URL (токен не попадает)
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        if not METRICS_ENABLED:
+            return await super().do_request(url, method, *args, **kwargs)
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(api_method, str(code))
+        return code, payload
+
 # ==================== ХРАНЕНИЕ ДАННЫХ ====================
-class DataStorage:
+class SessionSeries:
+    # Сессии одного пользователя, отсортированные по времени, в компактных массивах.
+    # Заметки хранятся в таблице строк, в массиве — только их индексы.
+    __slots__ = ("times", "durations", "duration_sums", "note_ids", "notes", "_note_index")
+
+    NO_DURATION = -1
+
+    def __init__(self):
+        self.times = array("d")          # epoch seconds
+        self.durations = array("q")      # секунды или NO_DURATION
+        self.duration_sums = array("q", [0])  # префиксные суммы длительностей
+        self.note_ids = array("I")       # индекс в notes
+        self.notes = []
+        self._note_index = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return self.sessions(0, len(self.times))
+
+    def append(self, time: datetime, note: str, duration_seconds: int = None):
+        self.append_raw(time.timestamp(), note, duration_seconds)
+
+    def append_raw(self, ts: float, note: str, duration_seconds: int = None):
+        note_id = self._note_index.get(note)
+        if note_id is None:
+            note_id = self._note_index[note] = len(self.notes)
+            self.notes.append(note)
+        duration = self.NO_DURATION if duration_seconds is None else duration_seconds
+
+        i = bisect_right(self.times, ts)
+        if i == len(self.times):
+            self.times.append(ts)
+            self.durations.append(duration)
+            self.note_ids.append(note_id)
+            self.duration_sums.append(self.duration_sums[-1] + max(duration, 0))
+            return
+
+        # Запись задним числом — вставляем и пересчитываем хвост префиксных сумм
+        self.times.insert(i, ts)
+        self.durations.insert(i, duration)
+        self.note_ids.insert(i, note_id)
+        self.duration_sums.append(0)
+        for j in range(i, len(self.times)):
+            self.duration_sums[j + 1] = self.duration_sums[j] + max(self.durations[j], 0)
+
+    def span(self, start: datetime, end: datetime = None) -> tuple:
+        # Индексы [lo, hi) сессий с start <= time < end
+        lo = bisect_left(self.times, start.timestamp())
+        hi = len(self.times) if end is None else bisect_left(self.times, end.timestamp(), lo)
+        return lo, hi
+
+    def total_duration(self, lo: int, hi: int) -> int:
+        # Сумма длительностей сессий [lo, hi) за O(1)
+        return self.duration_sums[hi] - self.duration_sums[lo]
+
+    def raw(self, i: int) -> tuple:
+        # -> (ts, note, duration_seconds) — аргументы append_raw
+        duration = self.durations[i]
+        return self.times[i], self.notes[self.note_ids[i]], None if duration == self.NO_DURATION else duration
+
+    def session(self, i: int) -> dict:
+        duration = self.durations[i]
+        return {
+            "time": datetime.fromtimestamp(self.times[i], MOSCOW_TZ),
+            "note": self.notes[self.note_ids[i]],
+            "duration_seconds": None if duration == self.NO_DURATION else duration
+        }
+
+    def sessions(self, lo: int, hi: int):
+        for i in range(lo, hi):
+            yield self.session(i)
+
+class StorageBackend:
+    # Постоянное хранилище истории и активных тренировок
+    persistent = True
+
+    def snapshot_marker(self):
+        # Отпечаток содержимого: снимок памяти годен, только пока он совпадает
+        return None
+
+    def load_user(self, user_id: int) -> dict:
+        # -> {"mindfulness": SessionSeries, "fitness": SessionSeries}
+        raise NotImplementedError
+
+    def load_active_sessions(self) -> dict:
+        raise NotImplementedError
+
+    def day_totals(self, day: int) -> dict:
+        # -> user_id -> (осознанность, тренировки, секунды) за московский день (ordinal)
+        raise NotImplementedError
+
+    def append_session(self, kind: str, user_id: int, session: dict):
+        raise NotImplementedError
+
+    def set_active_session(self, user_id: int, start_time: datetime):
+        raise NotImplementedError
+
+    def clear_active_session(self, user_id: int):
+        raise NotImplementedError
+
+    def iter_session_chunks(self, user_id: int = None, chunk_size: int = EXPORT_CHUNK_ROWS):
+        # -> списки строк (user_id, kind, ts, duration_seconds, note), не длиннее chunk_size
+        raise NotImplementedError
+
+    def bulk_append(self, rows: list):
+        # Строки как у iter_session_chunks, одной транзакцией
+        raise NotImplementedError
+
+    def needs_flush(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    async def flush_async(self):
+        pass
+
+    def close(self):
+        pass
+
+class MemoryBackend(StorageBackend):
+    # Ничего не сохраняет — данные живут только в процессе
+    persistent = False
+
+    def load_user(self, user_id: int) -> dict:
+        return {"mindfulness": SessionSeries(), "fitness": SessionSeries()}
+
+    def load_active_sessions(self) -> dict:
+        return {}
+
+    def day_totals(self, day: int) -> dict:
+        return {}
+
+    def append_session(self, kind: str, user_id: int, session: dict):
+        pass
+
+    def set_active_session(self, user_id: int, start_time: datetime):
+        pass
+
+    def clear_active_session(self, user_id: int):
+        pass
+
+    def iter_session_chunks(self, user_id: int = None, chunk_size: int = EXPORT_CHUNK_ROWS):
+        return iter(())
+
+    def bulk_append(self, rows: list):
+        pass
+
+class SQLiteBackend(StorageBackend):
+    # SQLite в режиме WAL: записи копятся в буфере и сбрасываются одной транзакцией
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            ts REAL NOT NULL,
+            note TEXT NOT NULL,
+            duration_seconds INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS sessions_user_kind_ts ON sessions (user_id, kind, ts);
+        CREATE INDEX IF NOT EXISTS sessions_ts ON sessions (ts);
+        CREATE TABLE IF NOT EXISTS active_sessions (
+            user_id INTEGER PRIMARY KEY,
+            start_ts REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_counters (
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            mindful INTEGER NOT NULL,
+            fitness INTEGER NOT NULL,
+            seconds INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        );
+    """
+    # Дневные итоги пишутся в той же транзакции, что и сессии: на старте их не пересчитываем
+    COUNTERS_UPSERT = (
+        "INSERT INTO daily_counters (day, user_id, mindful, fitness, seconds) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (day, user_id) DO UPDATE SET mindful = mindful + excluded.mindful, "
+        "fitness = fitness + excluded.fitness, seconds = seconds + excluded.seconds"
+    )
+
+    def __init__(self, path: str, batch_size: int = STORAGE_FLUSH_BATCH):
+        self.path = path
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        had_counters = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_counters'"
+        ).fetchone()
+        self._conn.executescript(self.SCHEMA)
+        if not had_counters:
+            self._backfill_counters()
+        self._lock = threading.Lock()
+        # Буфер пополняется в цикле событий, а сбрасывается и из потока flush_async —
+        # свой короткий замок, чтобы добавление не ждало конца транзакции
+        self._pending_lock = threading.Lock()
+        self._pending = []  # [(sql, params)] в порядке поступления
+
+    def load_user(self, user_id: int) -> dict:
+        self.flush()
+        result = {"mindfulness": SessionSeries(), "fitness": SessionSeries()}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, ts, note, duration_seconds FROM sessions WHERE user_id = ? ORDER BY ts",
+                (user_id,)
+            ).fetchall()
+        for kind, ts, note, duration in rows:
+            result[kind].append_raw(ts, note, duration)
+        return result
+
+    def load_active_sessions(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, start_ts FROM active_sessions").fetchall()
+        return {user_id: datetime.fromtimestamp(ts, MOSCOW_TZ) for user_id, ts in rows}
+
+    @staticmethod
+    def _counter_totals(rows) -> list:
+        # (user_id, kind, ts, duration_seconds) -> строки COUNTERS_UPSERT, сложенные по дню и пользователю
+        totals = {}
+        for user_id, kind, ts, duration in rows:
+            entry = totals.setdefault((ActivityCounters.day_of(datetime.fromtimestamp(ts, MOSCOW_TZ)), user_id), [0, 0, 0])
+            if kind == "mindfulness":
+                entry[0] += 1
+            else:
+                entry[1] += 1
+                entry[2] += duration or 0
+        return [(day, user_id, *entry) for (day, user_id), entry in totals.items()]
+
+    def _backfill_counters(self):
+        # База прежней версии: итоги последних дней один раз считаем по истории
+        since = (now_moscow() - timedelta(days=ActivityCounters.KEEP_DAYS)).timestamp()
+        rows = self._counter_totals(self._conn.execute(
+            "SELECT user_id, kind, ts, duration_seconds FROM sessions WHERE ts >= ?", (since,)
+        ))
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.executemany(self.COUNTERS_UPSERT, rows)
+        self._conn.execute("COMMIT")
+
+    def day_totals(self, day: int) -> dict:
+        # Заодно убираем дни, вышедшие из окна счётчиков
+        self.flush()
+        with self._lock:
+            self._conn.execute("DELETE FROM daily_counters WHERE day <= ?", (day - ActivityCounters.KEEP_DAYS,))
+            rows = self._conn.execute(
+                "SELECT user_id, mindful, fitness, seconds FROM daily_counters WHERE day = ?", (day,)
+            ).fetchall()
+        return {user_id: (mindful, fitness, seconds) for user_id, mindful, fitness, seconds in rows}
+
+    def _enqueue(self, *statements):
+        with self._pending_lock:
+            self._pending.extend(statements)
+
+    def append_session(self, kind: str, user_id: int, session: dict):
+        self._enqueue(
+            ("INSERT INTO sessions (user_id, kind, ts, note, duration_seconds) VALUES (?, ?, ?, ?, ?)",
+             (user_id, kind, session["time"].timestamp(), session["note"], session.get("duration_seconds"))),
+            # Версия истории: по ней другие процессы узнают, что их копия устарела
+            ("INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+             "ON CONFLICT (user_id) DO UPDATE SET version = version + 1",
+             (user_id,)),
+            (self.COUNTERS_UPSERT, self._counter_totals(
+                [(user_id, kind, session["time"].timestamp(), session.get("duration_seconds"))]
+            )[0])
+        )
+
+    def set_active_session(self, user_id: int, start_time: datetime):
+        self._enqueue((
+            "INSERT OR REPLACE INTO active_sessions (user_id, start_ts) VALUES (?, ?)",
+            (user_id, start_time.timestamp())
+        ))
+
+    def clear_active_session(self, user_id: int):
+        self._enqueue(("DELETE FROM active_sessions WHERE user_id = ?", (user_id,)))
+
+    def needs_flush(self) -> bool:
+        return len(self._pending) >= self.batch_size
+
+    def flush(self):
+        # Буфер забираем под замком соединения: пачки уходят в базу в порядке поступления
+        with self._lock:
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                for sql, params in batch:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                # Сначала возвращаем пачку в буфер: при занятой базе BEGIN не начнёт
+                # транзакцию, и откатывать будет нечего
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+
+    async def flush_async(self):
+        await asyncio.to_thread(self.flush)
+
+    def iter_session_chunks(self, user_id: int = None, chunk_size: int = EXPORT_CHUNK_ROWS):
+        # Отдельное соединение только на чтение: в WAL оно видит согласованный снимок
+        # и не мешает записи, а курсор отдаёт строки порциями в порядке индекса
+        self.flush()
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            sql = "SELECT user_id, kind, ts, duration_seconds, note FROM sessions"
+            if user_id is None:
+                cursor = conn.execute(sql + " ORDER BY user_id, kind, ts")
+            else:
+                cursor = conn.execute(sql + " WHERE user_id = ? ORDER BY kind, ts", (user_id,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.close()
+
+    def snapshot_marker(self):
+        self.flush()
+        with self._lock:
+            return self._conn.execute("SELECT max(rowid), count(*) FROM sessions").fetchone()
+
+    def bulk_append(self, rows: list):
+        self.flush()
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.executemany(
+                    "INSERT INTO sessions (user_id, kind, ts, duration_seconds, note) VALUES (?, ?, ?, ?, ?)", rows
+                )
+                self._conn.executemany(
+                    "INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+                    "ON CONFLICT (user_id) DO UPDATE SET version = version + 1",
+                    [(user_id,) for user_id in {row[0] for row in rows}]
+                )
+                since = (now_moscow() - timedelta(days=ActivityCounters.KEEP_DAYS)).timestamp()
+                self._conn.executemany(self.COUNTERS_UPSERT, self._counter_totals(
+                    (user_id, kind, ts, duration) for user_id, kind, ts, duration, _ in rows if ts >= since
+                ))
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+
+    # --- Общее состояние кластера: пишется сразу, в обход буфера ---
+    def _execute_now(self, sql: str, params=()) -> sqlite3.Cursor:
+        self.flush()
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def user_version(self, user_id: int) -> int:
+        row = self._execute_now("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def get_user_state(self, user_id: int):
+        row = self._execute_now("SELECT data FROM user_states WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_user_state(self, user_id: int, data: str):
+        self._execute_now(
+            "INSERT OR REPLACE INTO user_states (user_id, data, updated_at) VALUES (?, ?, ?)",
+            (user_id, data, time.time())
+        )
+
+    def delete_user_state(self, user_id: int) -> bool:
+        return self._execute_now("DELETE FROM user_states WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    def expire_user_states(self, before_ts: float) -> list:
+        # -> [(user_id, data)] удалённых состояний
+        self.flush()
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM user_states WHERE updated_at < ? RETURNING user_id, data", (before_ts,)
+            ).fetchall()
+
+    def user_state_ids(self) -> list:
+        return [row[0] for row in self._execute_now("SELECT user_id FROM user_states").fetchall()]
+
+    def count_rows(self, table: str) -> int:
+        # table — только имя из SCHEMA
+        return self._execute_now(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def get_active_session(self, user_id: int):
+        row = self._execute_now("SELECT start_ts FROM active_sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return datetime.fromtimestamp(row[0], MOSCOW_TZ) if row else None
+
+    def set_active_session_now(self, user_id: int, start_time: datetime):
+        self._execute_now(
+            "INSERT OR REPLACE INTO active_sessions (user_id, start_ts) VALUES (?, ?)",
+            (user_id, start_time.timestamp())
+        )
+
+    def claim_active_session(self, user_id: int, start_time: datetime) -> bool:
+        # Атомарно забирает тренировку: завершить её сможет только один процесс
+        return self._execute_now(
+            "DELETE FROM active_sessions WHERE user_id = ? AND start_ts = ?",
+            (user_id, start_time.timestamp())
+        ).rowcount > 0
+
+    def try_acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        self._execute_now(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+            (name, holder, now + ttl, now)
+        )
+        row = self._execute_now("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == holder
+
+    def live_lease_holders(self, prefix: str) -> set:
+        rows = self._execute_now(
+            "SELECT holder FROM leases WHERE name LIKE ? AND expires_at >= ?", (prefix + "%", time.time())
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+class ActivityCounters:
+    # Скользящие счётчики активности по московским дням:
+    # день (ordinal) -> user_id -> [осознанность, тренировки, секунды тренировок]
+    KEEP_DAYS = 7
+
     def __init__(self):
-        self.mindfulness_sessions = {}   # user_id -> [{'time': dt, 'note': str}]
-        self.fitness_sessions = {}       # user_id -> [{'time': dt, 'note': str, 'duration_seconds': int}]
+        self.days = {}
+
+    @staticmethod
+    def day_of(moment: datetime) -> int:
+        return moment.astimezone(MOSCOW_TZ).date().toordinal()
+
+    def record(self, kind: str, user_id: int, moment: datetime, duration_seconds: int = None):
+        day = self.day_of(moment)
+        oldest = self.day_of(now_moscow()) - self.KEEP_DAYS + 1
+        if day < oldest:
+            return
+        users = self.days.get(day)
+        if users is None:
+            users = self.days[day] = {}
+            for stale in [d for d in self.days if d < oldest]:
+                del self.days[stale]
+        totals = users.get(user_id)
+        if totals is None:
+            totals = users[user_id] = [0, 0, 0]
+        if kind == "mindfulness":
+            totals[0] += 1
+        else:
+            totals[1] += 1
+            totals[2] += duration_seconds or 0
+
+    def warm(self, rows):
+        for kind, user_id, ts, duration in rows:
+            self.record(kind, user_id, datetime.fromtimestamp(ts, MOSCOW_TZ), duration)
+
+    def totals(self, user_id: int, first_day: int, last_day: int) -> tuple:
+        mindful = fitness = seconds = 0
+        for day in range(first_day, last_day + 1):
+            day_totals = self.days.get(day, {}).get(user_id)
+            if day_totals:
+                mindful += day_totals[0]
+                fitness += day_totals[1]
+                seconds += day_totals[2]
+        return mindful, fitness, seconds
+
+    def users_on(self, day: int) -> dict:
+        return self.days.get(day, {})
+
+
+class UserStateStore(MutableMapping):
+    # Ограниченное хранилище состояний диалога: порядок OrderedDict — порядок последнего
+    # обращения, поэтому и простаивающие дольше ttl, и лишние сверх max_entries лежат в начале.
+    # Сброшенных пользователей помним (тоже не больше max_entries), чтобы ответить «сессия истекла».
+    def __init__(self, max_entries: int = USER_STATES_MAX, ttl: float = USER_STATE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._states = OrderedDict()   # user_id -> UserState
+        self._expired = OrderedDict()  # user_id -> None
+        self.evictions = Counter()     # причина -> количество
+        self.on_evict = None           # (user_id, UserState) -> None, до удаления состояния
+
+    def __getitem__(self, user_id):
+        state = self._states[user_id]
+        now = time.monotonic()
+        if now - state.touched > self.ttl:
+            self._evict(user_id, "ttl")
+            raise KeyError(user_id)
+        state.touched = now
+        self._states.move_to_end(user_id)
+        return state
+
+    def __setitem__(self, user_id, state):
+        state.touched = time.monotonic()
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        self._expired.pop(user_id, None)
+        self.sweep()
+        while len(self._states) > self.max_entries:
+            self._evict(next(iter(self._states)), "lru")
+
+    def __delitem__(self, user_id):
+        del self._states[user_id]
+
+    def __iter__(self):
+        return iter(self._states)
+
+    def __len__(self):
+        return len(self._states)
+
+    def sweep(self):
+        # Снимаем простаивающих с начала очереди: O(числа сброшенных)
+        deadline = time.monotonic() - self.ttl
+        while self._states:
+            user_id, state = next(iter(self._states.items()))
+            if state.touched >= deadline:
+                break
+            self._evict(user_id, "ttl")
+
+    async def sweep_async(self):
+        self.sweep()
+
+    def _evict(self, user_id, reason: str):
+        state = self._states.pop(user_id)
+        if self.on_evict:
+            self.on_evict(user_id, state)
+        self._expired[user_id] = None
+        if len(self._expired) > self.max_entries:
+            self._expired.popitem(last=False)
+        self.evictions[reason] += 1
+        USER_STATE_EVICTIONS.inc(reason)
+
+    def snapshot_items(self) -> list:
+        # Для снимка: без продления и вытеснения, порядок OrderedDict не трогаем
+        return list(self._states.items())
+
+    def consume_expired(self, user_id) -> bool:
+        # -> True один раз после того, как диалог пользователя был сброшен
+        return self._expired.pop(user_id, 0) is None
+
+    def stats(self) -> dict:
+        return {
+            "user_states": len(self._states),
+            "user_states_max": self.max_entries,
+            "user_states_expired_pending": len(self._expired),
+            "user_state_evictions_ttl": self.evictions["ttl"],
+            "user_state_evictions_lru": self.evictions["lru"]
+        }
+
+class SharedUserStates(MutableMapping):
+    # user_states поверх общей базы: состояние диалога видно всем процессам кластера
+    def __init__(self, backend: SQLiteBackend, ttl: float = USER_STATE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.on_evict = None
+
+    def __getitem__(self, user_id):
+        data = self.backend.get_user_state(user_id)
+        if data is None:
+            raise KeyError(user_id)
+        return UserState.from_json(data)
+
+    def __setitem__(self, user_id, state):
+        self.backend.set_user_state(user_id, state.to_json())
+
+    def __delitem__(self, user_id):
+        if not self.backend.delete_user_state(user_id):
+            raise KeyError(user_id)
+
+    def __iter__(self):
+        return iter(self.backend.user_state_ids())
+
+    def __len__(self):
+        return self.backend.count_rows("user_states")
+
+    def sweep(self):
+        self._evict_expired(self.backend.expire_user_states(time.time() - self.ttl))
+
+    async def sweep_async(self):
+        # Удаление — в потоке, сохранение сессий — в цикле событий, где живёт память хранилища
+        self._evict_expired(await asyncio.to_thread(self.backend.expire_user_states, time.time() - self.ttl))
+
+    def _evict_expired(self, expired: list):
+        # Каждую строку удаляет ровно один узел — он и сохраняет незавершённую сессию
+        for user_id, data in expired:
+            if self.on_evict:
+                self.on_evict(user_id, UserState.from_json(data))
+        if expired:
+            USER_STATE_EVICTIONS.inc("ttl", amount=len(expired))
+
+    def consume_expired(self, user_id) -> bool:
+        # Сброс по простою в общей базе не запоминается — отвечаем как обычно
+        return False
+
+class SharedActiveSessions(MutableMapping):
+    # active_fitness_sessions поверх общей базы
+    def __init__(self, backend: SQLiteBackend):
+        self.backend = backend
+
+    def __getitem__(self, user_id):
+        start_time = self.backend.get_active_session(user_id)
+        if start_time is None:
+            raise KeyError(user_id)
+        return start_time
+
+    def __setitem__(self, user_id, start_time):
+        self.backend.set_active_session_now(user_id, start_time)
+
+    def __delitem__(self, user_id):
+        start_time = self[user_id]
+        self.backend.claim_active_session(user_id, start_time)
+
+    def __iter__(self):
+        return iter(self.backend.load_active_sessions())
+
+    def __len__(self):
+        return self.backend.count_rows("active_sessions")
+
+    def items(self):
+        return self.backend.load_active_sessions().items()
+
+def create_storage_backend() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteBackend(DB_PATH)
+    return MemoryBackend()
+
+class DataStorage:
+    def __init__(self, backend: StorageBackend = None):
+        self.backend = backend or MemoryBackend()
+        self.mindfulness_sessions = {}   # user_id -> SessionSeries
+        self.fitness_sessions = {}       # user_id -> SessionSeries (с длительностями)
         self.active_fitness_sessions = {}  # user_id -> datetime (Moscow)
-        self.user_states = {}            # user_id -> dict
+        self.user_states = UserStateStore()  # user_id -> UserState
+        self.user_states.on_evict = self.save_pending_session
+        self.counters = ActivityCounters()
+        self.flush_requested = asyncio.Event()
+        self.shared = False
+        self._loaded_users = set()
+        self._versions = {}              # user_id -> версия истории в общей базе на момент загрузки
+
+    def open(self, backend: StorageBackend, shared: bool = False, snapshot_path: str = None) -> bool:
+        # На старте читаем только активные тренировки, историю — по первому обращению.
+        # В общем режиме состояния и активные тренировки живут в базе, а не в процессе.
+        # -> True, если память поднята из снимка
+        self.backend = backend
+        self.shared = shared
+        if shared:
+            self.active_fitness_sessions = SharedActiveSessions(backend)
+            self.user_states = SharedUserStates(backend)
+            self.user_states.on_evict = self.save_pending_session
+        else:
+            self.active_fitness_sessions.update(backend.load_active_sessions())
+            if snapshot_path and self.restore_snapshot(snapshot_path):
+                return True
+        return False
+
+    def ensure_user(self, user_id: int):
+        if self.shared:
+            # Историю могли дописать другие процессы — сверяем версию
+            version = self.backend.user_version(user_id)
+            if self._versions.get(user_id) == version:
+                return
+            self._versions[user_id] = version
+            self._load_user(user_id)
+            return
+        if user_id in self._loaded_users:
+            return
+        self._load_user(user_id)
+        self._loaded_users.add(user_id)
+
+    async def ensure_user_async(self, user_id: int):
+        # То же, что ensure_user, но чтение базы — в потоке: история в десятки тысяч
+        # строк не держит цикл событий. Если за время чтения пользователя успели
+        # загрузить синхронно (автозавершение, сброс диалога), прочитанное устарело
+        if self.shared:
+            loaded = self._versions.get(user_id)
+            version = await asyncio.to_thread(self.backend.user_version, user_id)
+            if loaded == version:
+                return
+            rows = await asyncio.to_thread(self.backend.load_user, user_id)
+            if self._versions.get(user_id) != loaded:
+                return
+            self._versions[user_id] = version
+            self._apply_user(user_id, rows)
+            return
+        if user_id in self._loaded_users:
+            return
+        rows = await asyncio.to_thread(self.backend.load_user, user_id)
+        if user_id in self._loaded_users:
+            return
+        self._apply_user(user_id, rows)
+        self._loaded_users.add(user_id)
+
+    def _load_user(self, user_id: int):
+        self._apply_user(user_id, self.backend.load_user(user_id))
+
+    def _apply_user(self, user_id: int, rows: dict):
+        for sessions, series in ((self.mindfulness_sessions, rows["mindfulness"]),
+                                 (self.fitness_sessions, rows["fitness"])):
+            if series:
+                sessions[user_id] = series
+            else:
+                sessions.pop(user_id, None)
+
+    def add_session(self, kind: str, user_id: int, session: dict):
+        # Уже загруженную историю по версии не сверяем: устаревшую копию
+        # перечитает следующий ensure_user_async
+        if user_id not in (self._versions if self.shared else self._loaded_users):
+            self.ensure_user(user_id)
+        sessions = self.mindfulness_sessions if kind == "mindfulness" else self.fitness_sessions
+        series = sessions.get(user_id)
+        if series is None:
+            series = sessions[user_id] = SessionSeries()
+        series.append(session["time"], session["note"], session.get("duration_seconds"))
+        if not self.backend.persistent:
+            self.counters.record(kind, user_id, session["time"], session.get("duration_seconds"))
+        self.backend.append_session(kind, user_id, session)
+        if self.shared:
+            self._versions[user_id] += 1
+        if self.backend.needs_flush():
+            self.flush_requested.set()
+
+    def save_pending_session(self, user_id: int, state):
+        # Сброшенный диалог не должен терять уже отмеченную сессию: осознанность
+        # и завершённую тренировку записываем без заметки. Тренировка без длительности
+        # ещё идёт — её завершит пользователь или автозавершение.
+        if state.state not in (State.NOTE_CONFIRMATION, State.NOTE_INPUT):
+            return
+        if state.session_type == "mindfulness":
+            self.add_session("mindfulness", user_id, {"time": state.session_time, "note": "Без заметки"})
+        elif state.duration is not None:
+            self.add_session("fitness", user_id, {
+                "time": state.session_time,
+                "note": "Без заметки",
+                "duration_seconds": int(state.duration.total_seconds())
+            })
+
+    SNAPSHOT_VERSION = 1
+
+    def save_snapshot(self, path: str):
+        # Пишем во временный файл и атомарно подменяем: на диске всегда целый снимок
+        snapshot = {
+            "version": self.SNAPSHOT_VERSION,
+            "marker": self.backend.snapshot_marker(),
+            "mindfulness": self.mindfulness_sessions,
+            "fitness": self.fitness_sessions,
+            "active": dict(self.active_fitness_sessions),
+            "user_states": self.user_states.snapshot_items() if isinstance(self.user_states, UserStateStore) else [],
+            "counters": self.counters.days
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def restore_snapshot(self, path: str) -> bool:
+        # История и счётчики берутся из снимка, только если
+        # постоянное хранилище не менялось с момента его записи; иначе — обычный холодный старт
+        try:
+            with open(path, "rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logger.error(f"Снимок {path} не прочитан: {e}")
+            return False
+        if snapshot.get("version") != self.SNAPSHOT_VERSION or snapshot["marker"] != self.backend.snapshot_marker():
+            logger.info(f"Снимок {path} устарел — загружаемся из хранилища")
+            return False
+        self.mindfulness_sessions = snapshot["mindfulness"]
+        self.fitness_sessions = snapshot["fitness"]
+        self._loaded_users = self.mindfulness_sessions.keys() | self.fitness_sessions.keys()
+        self.counters.days = snapshot["counters"]
+        if not self.backend.persistent:
+            self.active_fitness_sessions.update(snapshot["active"])
+        for user_id, state in snapshot["user_states"]:
+            self.user_states[user_id] = state
+        return True
+
+    def iter_session_chunks(self, user_id: int = None, chunk_size: int = EXPORT_CHUNK_ROWS):
+        if self.backend.persistent:
+            yield from self.backend.iter_session_chunks(user_id, chunk_size)
+            return
+        # Без постоянного хранилища вся история и так в памяти
+        users = [user_id] if user_id is not None else sorted(self.mindfulness_sessions.keys() | self.fitness_sessions.keys())
+        rows = []
+        for uid in users:
+            for kind, sessions in (("fitness", self.fitness_sessions), ("mindfulness", self.mindfulness_sessions)):
+                series = sessions.get(uid)
+                for i in range(len(series) if series else 0):
+                    ts, note, duration = series.raw(i)
+                    rows.append((uid, kind, ts, duration, note))
+                    if len(rows) == chunk_size:
+                        yield rows
+                        rows = []
+        if rows:
+            yield rows
+
+    def import_chunks(self, chunks) -> int:
+        # Каждая порция — одна транзакция; кеш загруженных пользователей потом сбрасывается
+        count = 0
+        week_start = (now_moscow() - timedelta(days=ActivityCounters.KEEP_DAYS)).timestamp()
+        for rows in chunks:
+            self.backend.bulk_append(rows)
+            if not self.backend.persistent:
+                for user_id, kind, ts, duration, note in rows:
+                    sessions = self.mindfulness_sessions if kind == "mindfulness" else self.fitness_sessions
+                    series = sessions.get(user_id)
+                    if series is None:
+                        series = sessions[user_id] = SessionSeries()
+                    series.append_raw(ts, note, duration)
+                self.counters.warm((kind, user_id, ts, duration)
+                                   for user_id, kind, ts, duration, _ in rows if ts >= week_start)
+            count += len(rows)
+        if self.backend.persistent:
+            self.mindfulness_sessions.clear()
+            self.fitness_sessions.clear()
+            self._loaded_users.clear()
+            self._versions.clear()
+        return count
+
+    async def day_totals(self, day: int) -> dict:
+        # Постоянное хранилище ведёт дневные итоги само; без него они только в памяти
+        if self.backend.persistent:
+            return await asyncio.to_thread(self.backend.day_totals, day)
+        return dict(self.counters.users_on(day))
+
+    def start_active_session(self, user_id: int, start_time: datetime):
+        self.active_fitness_sessions[user_id] = start_time
+        if not self.shared:
+            self.backend.set_active_session(user_id, start_time)
+
+    def claim_active_session(self, user_id: int, start_time: datetime) -> bool:
+        # Завершить тренировку может только один: пользователь или авто-завершение
+        if self.shared:
+            return self.backend.claim_active_session(user_id, start_time)
+        if self.active_fitness_sessions.get(user_id) != start_time:
+            return False
+        del self.active_fitness_sessions[user_id]
+        self.backend.clear_active_session(user_id)
+        return True
+
+    def finish_active_session(self, user_id: int):
+        start_time = self.active_fitness_sessions.get(user_id)
+        if start_time is None or not self.claim_active_session(user_id, start_time):
+            return None
+        return start_time
+
+    async def offload(self, fn, *args):
+        # В общем режиме состояния и активные тренировки — запросы к SQLite с ожиданием
+        # занятой базы до 5 с: выполняем их в потоке. В памяти — сразу, без переключений
+        if self.shared:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def get_state(self, user_id: int) -> "UserState":
+        return await self.offload(self.user_states.get, user_id, IDLE)
+
+    async def set_state(self, user_id: int, state: "UserState"):
+        await self.offload(self.user_states.__setitem__, user_id, state)
+
+    async def clear_state(self, user_id: int):
+        await self.offload(self.user_states.pop, user_id, None)
+
+    def close(self):
+        self.backend.close()
 
 storage = DataStorage()
 
+# ==================== ЭКСПОРТ И ИМПОРТ ====================
+# Колоночный формат: EXPORT_MAGIC, затем порции до пустой порции-терминатора.
+# Порция: "<II" (n сессий, m строк в таблице заметок), длины строк ("I" × m) и их UTF-8,
+# затем колонки по n значений: user_id "q", вид "B", время "d", длительность "q", индекс заметки "I".
+# Числа записываются в little-endian.
+EXPORT_MAGIC = b"CHMS\x01"
+SESSION_KINDS = ("mindfulness", "fitness")
+CSV_HEADER = ("user_id", "kind", "time", "duration_seconds", "note")
+
+def _pack_column(typecode: str, values) -> bytes:
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+def _read_exact(inp, size: int) -> bytes:
+    data = inp.read(size)
+    if len(data) != size:
+        raise ValueError("Файл экспорта обрезан")
+    return data
+
+def _read_column(inp, typecode: str, count: int) -> array:
+    column = array(typecode)
+    column.frombytes(_read_exact(inp, column.itemsize * count))
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+def write_columnar(chunks, out) -> int:
+    out.write(EXPORT_MAGIC)
+    count = 0
+    for rows in chunks:
+        notes, note_index, note_ids = [], {}, []
+        for row in rows:
+            note_id = note_index.get(row[4])
+            if note_id is None:
+                note_id = note_index[row[4]] = len(notes)
+                notes.append(row[4].encode("utf-8"))
+            note_ids.append(note_id)
+        out.write(struct.pack("<II", len(rows), len(notes)))
+        out.write(_pack_column("I", map(len, notes)))
+        out.write(b"".join(notes))
+        out.write(_pack_column("q", [row[0] for row in rows]))
+        out.write(_pack_column("B", [SESSION_KINDS.index(row[1]) for row in rows]))
+        out.write(_pack_column("d", [row[2] for row in rows]))
+        out.write(_pack_column("q", [SessionSeries.NO_DURATION if row[3] is None else row[3] for row in rows]))
+        out.write(_pack_column("I", note_ids))
+        count += len(rows)
+    out.write(struct.pack("<II", 0, 0))
+    return count
+
+def read_columnar(inp):
+    if _read_exact(inp, len(EXPORT_MAGIC)) != EXPORT_MAGIC:
+        raise ValueError("Неизвестный формат файла экспорта")
+    while True:
+        n, m = struct.unpack("<II", _read_exact(inp, 8))
+        if not n:
+            return
+        lengths = _read_column(inp, "I", m)
+        blob = _read_exact(inp, sum(lengths))
+        notes, offset = [], 0
+        for length in lengths:
+            notes.append(blob[offset:offset + length].decode("utf-8"))
+            offset += length
+        user_ids = _read_column(inp, "q", n)
+        kinds = _read_column(inp, "B", n)
+        times = _read_column(inp, "d", n)
+        durations = _read_column(inp, "q", n)
+        note_ids = _read_column(inp, "I", n)
+        yield [
+            (user_ids[i], SESSION_KINDS[kinds[i]], times[i],
+             None if durations[i] == SessionSeries.NO_DURATION else durations[i], notes[note_ids[i]])
+            for i in range(n)
+        ]
+
+def write_csv(chunks, out) -> int:
+    # out — бинарный файл; каждая порция кодируется и пишется целиком
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    count = 0
+    for rows in chunks:
+        for user_id, kind, ts, duration, note in rows:
+            moment = datetime.fromtimestamp(ts, MOSCOW_TZ).isoformat()
+            writer.writerow((user_id, kind, moment, "" if duration is None else duration, note))
+        out.write(buffer.getvalue().encode("utf-8"))
+        buffer.seek(0)
+        buffer.truncate()
+        count += len(rows)
+    out.write(buffer.getvalue().encode("utf-8"))
+    return count
+
+def read_csv(inp, chunk_size: int = EXPORT_CHUNK_ROWS):
+    reader = csv.reader(io.TextIOWrapper(inp, encoding="utf-8", newline=""))
+    if tuple(next(reader, ())) != CSV_HEADER:
+        raise ValueError(f"Ожидался CSV с колонками {','.join(CSV_HEADER)}")
+    rows = []
+    for user_id, kind, moment, duration, note in reader:
+        if kind not in SESSION_KINDS:
+            raise ValueError(f"Неизвестный вид сессии: {kind}")
+        rows.append((int(user_id), kind, datetime.fromisoformat(moment).timestamp(),
+                     int(duration) if duration else None, note))
+        if len(rows) == chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+EXPORT_FORMATS = {"csv": (write_csv, read_csv), "bin": (write_columnar, read_columnar)}  # формат -> (запись, чтение)
+
+def export_format_of(path: str) -> str:
+    return "csv" if path.lower().endswith(".csv") else "bin"
+
 # ==================== КЛАВИАТУРЫ ====================
-def create_keyboard(buttons, resize=True, one_time=False):
-    return ReplyKeyboardMarkup(buttons, resize_keyboard=resize, one_time_keyboard=one_time)
-
-def main_menu():
-    return create_keyboard([
-        [KeyboardButton("💡 Задание"), KeyboardButton("📅 Рефлексия")],
-        [KeyboardButton("✨ Я осознан!")],
-        [KeyboardButton("⏱ Начать тренировку"), KeyboardButton("🏁 Закончить тренировку")],
-        [KeyboardButton("🧠 Поговорить с ИИ")],
-        [KeyboardButton("📊 Статистика")]
-    ])
-
-def stats_category_menu():
-    return create_keyboard([
-        [KeyboardButton("📊 Статистика по осознанности")],
-        [KeyboardButton("📊 Статистика по спорту")],
-        [KeyboardButton("🔙 Назад")]
-    ])
-
-def stats_period_menu():
-    return create_keyboard([
-        [KeyboardButton("📅 За день"), KeyboardButton("📆 За неделю")],
-        [KeyboardButton("🔙 Назад")]
-    ])
-
-def note_confirmation_menu():
-    return create_keyboard([
-        [KeyboardButton("📝 Записать заметку"), KeyboardButton("❌ Отменить")]
-    ])
-
-def note_input_menu():
-    return create_keyboard([
-        [KeyboardButton("❌ Пропустить заметку"), KeyboardButton("🔄 Отменить")]
-    ], one_time=True)
-
-def cancel_menu():
-    return create_keyboard([[KeyboardButton("❌ Отмена")]], one_time=True)
+# Клавиатуры неизменяемы: собираются и сериализуются в JSON один раз при импорте.
+# Строковые параметры PTB передаёт в Bot API как есть, без повторного кодирования.
+def create_keyboard(buttons, resize=True, one_time=False) -> str:
+    markup = ReplyKeyboardMarkup(buttons, resize_keyboard=resize, one_time_keyboard=one_time)
+    return json.dumps(markup.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+MAIN_MENU = create_keyboard([
+    [KeyboardButton("💡 Задание"), KeyboardButton("📅 Рефлексия")],
+    [KeyboardButton("✨ Я осознан!")],
+    [KeyboardButton("⏱ Начать тренировку"), KeyboardButton("🏁 Закончить тренировку")],
+    [KeyboardButton("🧠 Поговорить с ИИ")],
+    [KeyboardButton("📊 Статистика")]
+])
+
+STATS_CATEGORY_MENU = create_keyboard([
+    [KeyboardButton("📊 Статистика по осознанности")],
+    [KeyboardButton("📊 Статистика по спорту")],
+    [KeyboardButton("🔙 Назад")]
+])
+
+STATS_PERIOD_MENU = create_keyboard([
+    [KeyboardButton("📅 За день"), KeyboardButton("📆 За неделю")],
+    [KeyboardButton("🔙 Назад")]
+])
+
+NOTE_CONFIRMATION_MENU = create_keyboard([
+    [KeyboardButton("📝 Записать заметку"), KeyboardButton("❌ Отменить")]
+])
+
+NOTE_INPUT_MENU = create_keyboard([
+    [KeyboardButton("❌ Пропустить заметку"), KeyboardButton("🔄 Отменить")]
+], one_time=True)
+
+CANCEL_MENU = create_keyboard([[KeyboardButton("❌ Отмена")]], one_time=True)
+
+# ==================== ШАБЛОНЫ ОТВЕТОВ ====================
+class Reply:
+    # Текст ответа с готовой разметкой. Поля {name} подставляются при отправке;
+    # наличие полей определяется один раз, постоянные тексты уходят без форматирования.
+    __slots__ = ("text", "markup", "parse_mode", "has_fields")
+
+    def __init__(self, text: str, markup: str = None, parse_mode: str = None):
+        self.text = text
+        self.markup = markup
+        self.parse_mode = parse_mode
+        self.has_fields = any(field is not None for _, field, _, _ in Formatter().parse(text))
+
+    def render(self, **fields) -> str:
+        return self.text.format_map(fields) if self.has_fields else self.text
+
+    async def send(self, update: Update, **fields):
+        return await update.message.reply_text(self.render(**fields), reply_markup=self.markup,
+                                               parse_mode=self.parse_mode)
+
+REPLY_START = Reply(
+    "Привет! Я бот для осознанности и тренировок. "
+    "Используй кнопки ниже, чтобы отмечать свою активность.",
+    MAIN_MENU
+)
+REPLY_EXPORT_EMPTY = Reply("📭 Пока нечего выгружать — записанных сессий нет.", MAIN_MENU)
+REPLY_START_WITH_WORKOUT = Reply(
+    "⚠️ У вас уже запущена тренировка с {time}!\n"
+    "Не забудьте завершить её кнопкой «🏁 Закончить тренировку».\n\n"
+    "Привет! Давай развиваться вместе 🌱",
+    MAIN_MENU
+)
+REPLY_MAIN_MENU = Reply("Главное меню:", MAIN_MENU)
+REPLY_USE_MENU = Reply("Пожалуйста, используйте кнопки меню.", MAIN_MENU)
+REPLY_THINKING = Reply("🧠 Думаю...", MAIN_MENU)
+REPLY_AI_PROMPT = Reply("💭 Напиши, что тебя волнует. Я постараюсь помочь с позиции осознанности.", CANCEL_MENU)
+REPLY_AI_CANCELLED = Reply("Общение с ИИ отменено.", MAIN_MENU)
+REPLY_ASK_MINDFULNESS_NOTE = Reply("Хотите записать заметку об осознанности?", NOTE_CONFIRMATION_MENU)
+REPLY_CHOOSE_ACTION = Reply("Пожалуйста, выберите действие.", NOTE_CONFIRMATION_MENU)
+REPLY_ENTER_NOTE = Reply("Напишите заметку:", NOTE_INPUT_MENU)
+REPLY_NOTE_SAVED = Reply("✅ Заметка сохранена: «{note}»", MAIN_MENU)
+REPLY_SAVED_WITHOUT_NOTE = Reply("Сессия сохранена без заметки.", MAIN_MENU)
+REPLY_CANCELLED = Reply("Действие отменено.", MAIN_MENU)
+REPLY_SESSION_EXPIRED = Reply("⌛ Диалог сброшен из-за долгого бездействия. Начните заново из меню.", MAIN_MENU)
+REPLY_WORKOUT_STARTED = Reply("✅ Тренировка начата в {time}!", NOTE_CONFIRMATION_MENU)
+REPLY_WORKOUT_ALREADY_STARTED = Reply("Тренировка уже запущена! Сначала завершите текущую.", MAIN_MENU)
+REPLY_WORKOUT_NOT_STARTED = Reply("Тренировка не была начата.", MAIN_MENU)
+REPLY_WORKOUT_FINISHED = Reply(
+    "🎉 Тренировка завершена!\n"
+    "⏱ Длительность: {duration}\n"
+    "Хотите записать заметку?",
+    NOTE_CONFIRMATION_MENU
+)
+REPLY_STATS_CATEGORY = Reply("Выберите категорию статистики:", STATS_CATEGORY_MENU)
+REPLY_STATS_BACK_TO_CATEGORY = Reply("Выберите категорию:", STATS_CATEGORY_MENU)
+REPLY_CHOOSE_CATEGORY = Reply("Выберите из меню.", STATS_CATEGORY_MENU)
+REPLY_STATS_PERIOD = Reply("Выберите период:", STATS_PERIOD_MENU)
+REPLY_CHOOSE_PERIOD = Reply("Выберите из меню.", STATS_PERIOD_MENU)
+REPLY_NO_STATS = Reply("За выбранный период нет данных по {title}.", MAIN_MENU)
+
+# ==================== РАССЫЛКИ ====================
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BroadcastReport:
+    __slots__ = ("name", "total", "sent", "failed", "retries", "errors", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.total = self.sent = self.failed = self.retries = 0
+        self.errors = {}  # chat_id -> текст последней ошибки
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def __str__(self):
+        return (f"{self.name}: отправлено {self.sent}/{self.total}, ошибок {self.failed}, "
+                f"повторов {self.retries}, {self.elapsed:.1f}с")
+
+class Broadcaster:
+    # Очередь отправки с ограниченным параллелизмом, общим token bucket,
+    # интервалом на чат и паузой по RetryAfter
+    def __init__(self, bot=None, concurrency: int = BROADCAST_CONCURRENCY, rate: float = BROADCAST_RATE,
+                 per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL, max_retries: int = BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self._resume_at = 0.0    # monotonic-время окончания флуд-паузы
+        self._chat_last = {}     # chat_id -> monotonic-время последней отправки
+
+    async def _wait_turn(self, chat_id: int):
+        while True:
+            now = time.monotonic()
+            wait = max(self._resume_at - now, self._chat_last.get(chat_id, 0.0) + self.per_chat_interval - now)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        await self.bucket.acquire()
+        self._chat_last[chat_id] = time.monotonic()
+        if len(self._chat_last) > 10000:
+            stale = time.monotonic() - self.per_chat_interval
+            self._chat_last = {c: t for c, t in self._chat_last.items() if t > stale}
+
+    async def send(self, chat_id: int, text: str, report: BroadcastReport = None, **kwargs) -> bool:
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                if report:
+                    report.sent += 1
+                return True
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                error = e
+            except (Forbidden, BadRequest) as e:
+                error = e
+                break
+            except NetworkError as e:
+                await asyncio.sleep(min(2 ** attempt, 30) * (0.5 + random.random()))
+                error = e
+            except Exception as e:
+                error = e
+                break
+            if report and attempt < self.max_retries:
+                report.retries += 1
+        if report:
+            report.failed += 1
+            report.errors[chat_id] = str(error)
+        logger.error(f"Не удалось отправить сообщение {chat_id}: {error}")
+        return False
+
+    async def broadcast(self, messages, name: str = "Рассылка", on_progress=None, **kwargs) -> BroadcastReport:
+        # messages — итерируемое (chat_id, text); читается лениво, в памяти не больше очереди
+        report = BroadcastReport(name)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                await self.send(*item, report=report, **kwargs)
+                done = report.sent + report.failed
+                if done % BROADCAST_PROGRESS_EVERY == 0:
+                    logger.info(f"📨 {report}")
+                    if on_progress:
+                        on_progress(report)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for chat_id, text in messages:
+                report.total += 1
+                await queue.put((chat_id, text))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        logger.info(f"📨 {report}")
+        if on_progress:
+            on_progress(report)
+        return report
+
+broadcaster = Broadcaster()
+
+# ==================== СУПЕРВИЗОР ЗАДАЧ ====================
+class TaskSupervisor:
+    # Учёт всех фоновых задач. Циклы (планировщик, сброс хранилища, ...) при остановке
+    # отменяются сразу, а начатая работа (рассылки, сработавшие таймеры) дорабатывает до дедлайна.
+    def __init__(self):
+        self._loops = set()
+        self._work = set()
+        self.stopping = asyncio.Event()
+
+    def spawn_loop(self, coroutine, name: str) -> asyncio.Task:
+        return self._track(self._loops, coroutine, name)
+
+    def spawn(self, coroutine, name: str) -> asyncio.Task:
+        return self._track(self._work, coroutine, name)
+
+    def _track(self, tasks: set, coroutine, name: str) -> asyncio.Task:
+        task = asyncio.create_task(coroutine, name=name)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(self._report)
+        return task
+
+    @staticmethod
+    def _report(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Задача {task.get_name()} упала: {task.exception()!r}")
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except NotImplementedError:  # Windows
+                pass
+
+    async def drain(self, deadline: float) -> int:
+        # -> сколько задач пришлось прервать по дедлайну
+        for task in self._loops:
+            task.cancel()
+        pending = set()
+        if self._work:
+            logger.info(f"Дожидаемся {len(self._work)} задач (не дольше {deadline:.1f} с)")
+            _, pending = await asyncio.wait(set(self._work), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._loops, *pending, return_exceptions=True)
+        return len(pending)
+
+supervisor = TaskSupervisor()
+
+# ==================== ПЛАНИРОВЩИК ====================
+class DeadlineScheduler:
+    # Задачи по ключу с абсолютным сроком: регистрация и отмена за O(log n),
+    # срабатывание точно в срок без периодического опроса
+    def __init__(self):
+        self._heap = []   # (when_ts, seq, key); отменённые записи удаляются лениво
+        self._jobs = {}   # key -> (when_ts, seq, callback)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    def schedule(self, key, when: datetime, callback):
+        # callback — корутинная функция без аргументов; повторная регистрация ключа заменяет задачу
+        self._seq += 1
+        when_ts = when.timestamp()
+        self._jobs[key] = (when_ts, self._seq, callback)
+        heapq.heappush(self._heap, (when_ts, self._seq, key))
+        if self._heap[0][1] == self._seq:
+            self._wakeup.set()
+
+    def cancel(self, key) -> bool:
+        if self._jobs.pop(key, None) is None:
+            return False
+        if len(self._heap) > 2 * len(self._jobs) + 64:
+            self._heap = [entry for entry in self._heap if self._is_live(entry)]
+            heapq.heapify(self._heap)
+        return True
+
+    def _is_live(self, entry) -> bool:
+        job = self._jobs.get(entry[2])
+        return job is not None and job[1] == entry[1]
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            while self._heap and not self._is_live(self._heap[0]):
+                heapq.heappop(self._heap)
+            if self._heap and self._heap[0][0] <= time.time():
+                _, _, key = heapq.heappop(self._heap)
+                callback = self._jobs.pop(key)[2]
+                supervisor.spawn(self._fire(key, callback), name=f"scheduler:{key}")
+                continue
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key, callback):
+        self.fired += 1
+        started = time.perf_counter()
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Ошибка задачи планировщика {key}: {e}")
+        finally:
+            LOOP_TICK_SECONDS.observe(time.perf_counter() - started, "scheduler_job")
+
+scheduler = DeadlineScheduler()
+
+# ==================== КЛИЕНТ YANDEXGPT ====================
+class AIRequestError(Exception):
+    pass
+
+class LatencyWindow:
+    # Последние замеры (секунды) для перцентилей
+    def __init__(self, size: int = 1000):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def summary(self) -> dict:
+        return {"p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+                "count": len(self.samples)}
+
+class YandexGPTClient:
+    # Один пул keep-alive соединений на всё время жизни приложения
+    def __init__(self, url: str = YC_API_URL, max_concurrency: int = AI_MAX_CONCURRENCY,
+                 timeout: float = AI_TIMEOUT_SECONDS, max_retries: int = AI_MAX_RETRIES):
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.queue_wait = LatencyWindow()
+        self.latency = LatencyWindow()
+        self.first_chunk = LatencyWindow()
+        self.requests = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.errors = Counter()  # HTTP-статус или тип исключения -> количество
+
+    async def start(self):
+        if self.session is not None:
+            return
+        connector = TCPConnector(limit=AI_POOL_SIZE, ttl_dns_cache=AI_DNS_CACHE_SECONDS, keepalive_timeout=60)
+        self.session = ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=self.timeout),
+            headers={"Authorization": f"Api-Key {YC_API_KEY}", "Content-Type": "application/json"}
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def complete(self, payload: dict) -> dict:
+        await self.start()
+        queued = time.monotonic()
+        async with self._semaphore:
+            self.queue_wait.add(time.monotonic() - queued)
+            self.in_flight += 1
+            try:
+                started = time.monotonic()
+                async with await self._post(payload) as resp:
+                    data = await resp.json()
+                self.latency.add(time.monotonic() - started)
+                AI_SECONDS.observe(time.monotonic() - started, "complete")
+                return data
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.errors[type(e).__name__] += 1
+                AI_ERRORS.inc(type(e).__name__)
+                raise AIRequestError(f"{type(e).__name__}: {e}") from e
+            finally:
+                self.in_flight -= 1
+
+    async def stream(self, payload: dict):
+        # Потоковый режим: YandexGPT присылает JSON-строки с накопленным текстом ответа
+        await self.start()
+        options = {**payload["completionOptions"], "stream": True}
+        payload = {**payload, "completionOptions": options}
+        queued = time.monotonic()
+        async with self._semaphore:
+            self.queue_wait.add(time.monotonic() - queued)
+            self.in_flight += 1
+            try:
+                started = time.monotonic()
+                first_chunk = True
+                async with await self._post(payload) as resp:
+                    async for line in resp.content:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        if first_chunk:
+                            self.first_chunk.add(time.monotonic() - started)
+                            AI_SECONDS.observe(time.monotonic() - started, "stream_first_chunk")
+                            first_chunk = False
+                        yield extract_ai_text(json.loads(line))
+                self.latency.add(time.monotonic() - started)
+                AI_SECONDS.observe(time.monotonic() - started, "stream")
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.errors[type(e).__name__] += 1
+                AI_ERRORS.inc(type(e).__name__)
+                raise AIRequestError(f"{type(e).__name__}: {e}") from e
+            finally:
+                self.in_flight -= 1
+
+    async def _post(self, payload: dict):
+        # -> ответ со статусом 200; 429/5xx и сетевые ошибки до получения ответа повторяются.
+        # Все попытки вместе с чтением ответа укладываются в один таймаут self.timeout
+        deadline = time.monotonic() + self.timeout
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            try:
+                resp = await self.session.post(
+                    self.url, json=payload, timeout=ClientTimeout(total=deadline - time.monotonic())
+                )
+                if resp.status == 200:
+                    return resp
+                error_text = await resp.text()
+                resp.release()
+                self.errors[str(resp.status)] += 1
+                AI_ERRORS.inc(str(resp.status))
+                error = AIRequestError(f"YandexGPT error {resp.status}: {error_text}")
+                retryable = resp.status == 429 or resp.status >= 500
+            except (ClientError, asyncio.TimeoutError) as e:
+                self.errors[type(e).__name__] += 1
+                AI_ERRORS.inc(type(e).__name__)
+                error = AIRequestError(f"{type(e).__name__}: {e}")
+                retryable = True
+            pause = random.uniform(0, AI_RETRY_BASE_SECONDS * 2 ** attempt)
+            if not retryable or attempt == self.max_retries or time.monotonic() + pause >= deadline:
+                raise error
+            self.retries += 1
+            await asyncio.sleep(pause)
+
+    def metrics(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "in_flight": self.in_flight,
+            "errors": dict(self.errors),
+            "queue_wait_seconds": self.queue_wait.summary(),
+            "latency_seconds": self.latency.summary(),
+            "first_chunk_seconds": self.first_chunk.summary()
+        }
+
+class AIResponseCache:
+    # LRU + TTL по нормализованному запросу и параметрам модели.
+    # Одинаковые запросы, пришедшие одновременно, ждут один вызов API.
+    def __init__(self, max_entries: int = AI_CACHE_MAX_ENTRIES, max_bytes: int = AI_CACHE_MAX_BYTES,
+                 ttl: float = AI_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, text, size)
+        self._in_flight = {}           # key -> Future
+        self.hits = self.misses = self.coalesced = self.evictions = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        return " ".join(prompt.lower().replace("ё", "е").split()).strip(" .,!?…;:")
+
+    @classmethod
+    def key_for(cls, payload: dict) -> tuple:
+        options = payload["completionOptions"]
+        system, user = payload["messages"][0]["content"], payload["messages"][-1]["content"]
+        return (cls.normalize(user), system, options["temperature"], options["maxTokens"], payload["modelUri"])
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: tuple, text: str):
+        size = len(text.encode("utf-8")) + len(key[0].encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, text, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: tuple):
+        self.bytes -= self._entries.pop(key)[2]
+
+    async def get_or_fetch(self, key: tuple, fetch) -> str:
+        text = self.get(key)
+        if text is not None:
+            self.hits += 1
+            self.saved_seconds += ai_client.latency.percentile(50)
+            return text
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            self.saved_seconds += ai_client.latency.percentile(50)
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        pending = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            text = await fetch()
+        except BaseException as e:
+            # Отмена касается только владельца вызова: ожидающим — обычная ошибка запроса
+            if isinstance(e, asyncio.CancelledError):
+                e = AIRequestError("запрос к ИИ отменён")
+            pending.set_exception(e)
+            pending.exception()  # ошибку получат ожидающие, без предупреждения о потерянном исключении
+            raise
+        else:
+            if text:  # пустой ответ не кэшируем — следующий такой же запрос спросит заново
+                self.put(key, text)
+            pending.set_result(text)
+            return text
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "saved_api_calls": self.hits + self.coalesced,
+            "saved_seconds": round(self.saved_seconds, 3)
+        }
+
+def extract_ai_text(data: dict) -> str:
+    message = data["result"]["alternatives"][0]["message"]
+    return message.get("content", message.get("text", ""))
+
+ai_client = YandexGPTClient()
+ai_cache = AIResponseCache()
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 def now_moscow() -> datetime:
@@ -90,65 +1874,113 @@ def format_duration(seconds: int) -> str:
         return f"{minutes}м {seconds}с"
     return f"{seconds}с"
 
-async def get_ai_response(prompt: str) -> str:
-    if not YC_API_KEY or not YC_FOLDER_ID:
-        return "❌ ИИ не настроен. Обратитесь к разработчику."
-
-    system_message = (
-        "Ты — тёплый и мудрый наставник по осознанности, внимательности и внутреннему росту. "
-        "Отвечай кратко (1–3 предложения), с заботой, без оценок. "
-        "Говори как друг, который понимает. Используй мягкие метафоры и эмодзи, когда уместно."
-    )
+AI_SYSTEM_MESSAGE = (
+    "Ты — тёплый и мудрый наставник по осознанности, внимательности и внутреннему росту. "
+    "Отвечай кратко (1–3 предложения), с заботой, без оценок. "
+    "Говори как друг, который понимает. Используй мягкие метафоры и эмодзи, когда уместно."
+)
 
-    payload = {
+def build_ai_payload(prompt: str) -> dict:
+    return {
         "modelUri": f"gpt://{YC_FOLDER_ID}/yandexgpt-lite/latest",
         "completionOptions": {
             "temperature": 0.6,
             "maxTokens": 500
         },
         "messages": [
-            {"role": "system", "content": system_message},
+            {"role": "system", "content": AI_SYSTEM_MESSAGE},
             {"role": "user", "content": prompt}
         ]
     }
 
-    headers = {
-        "Authorization": f"Api-Key {YC_API_KEY}",
-        "Content-Type": "application/json"
-    }
+AI_EMPTY_RESPONSE = "🧠 ИИ не смог ответить на этот вопрос. Попробуй сформулировать иначе."
+
+async def get_ai_response(prompt: str, on_partial=None) -> str:
+    # on_partial(text) получает накопленный текст по мере прихода потока
+    if not YC_API_KEY or not YC_FOLDER_ID:
+        return "❌ ИИ не настроен. Обратитесь к разработчику."
+
+    payload = build_ai_payload(prompt)
+
+    async def fetch():
+        if on_partial is None or not AI_STREAMING:
+            data = await ai_client.complete(payload)
+            return extract_ai_text(data).strip()
+        text = ""
+        async for text in ai_client.stream(payload):
+            await on_partial(text)
+        return text.strip()
 
     try:
-        async with ClientSession() as session:
-            async with session.post(YC_API_URL, json=payload, headers=headers, timeout=15) as resp:
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    logger.error("YandexGPT error %d: %s", resp.status, error_text)
-                    return "🧠 Извини, не могу подключиться к ИИ. Попробуй позже."
-                data = await resp.json()
-                return data["result"]["alternatives"][0]["message"]["content"].strip()
+        return await ai_cache.get_or_fetch(AIResponseCache.key_for(payload), fetch) or AI_EMPTY_RESPONSE
+    except AIRequestError as e:
+        logger.error("YandexGPT request failed: %s", e)
+        return "🧠 Извини, не могу подключиться к ИИ. Попробуй позже."
     except Exception as e:
         logger.error("YandexGPT request failed: %s", e)
         return "🧠 Извини, произошла ошибка при общении с ИИ."
 
+class ThrottledEditor:
+    # Правит одно сообщение по мере прихода текста, не чаще раза в interval секунд
+    def __init__(self, message, interval: float = AI_STREAM_EDIT_SECONDS):
+        self.message = message
+        self.interval = interval
+        self.shown = message.text
+        self.last_edit = 0.0  # первый фрагмент показываем сразу
+
+    async def update(self, text: str):
+        text = text.strip()
+        if not text or text == self.shown or time.monotonic() - self.last_edit < self.interval:
+            return
+        await self._edit(text + " ▌")
+
+    async def finish(self, text: str) -> bool:
+        return text == self.shown or await self._edit(text)
+
+    async def _edit(self, text: str) -> bool:
+        self.last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(text)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                logger.error(f"Ошибка правки сообщения: {e}")
+                return False
+        except Exception as e:
+            logger.error(f"Ошибка правки сообщения: {e}")
+            return False
+        self.shown = text
+        return True
+
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    storage.user_states.pop(user.id, None)
+    await storage.ensure_user_async(user.id)
+    await storage.clear_state(user.id)
     
-    if user.id in storage.active_fitness_sessions:
-        start_time = storage.active_fitness_sessions[user.id]
-        await update.message.reply_text(
-            f"⚠️ У вас уже запущена тренировка с {start_time.strftime('%H:%M')}!\n"
-            "Не забудьте завершить её кнопкой «🏁 Закончить тренировку».\n\n"
-            "Привет! Давай развиваться вместе 🌱",
-            reply_markup=main_menu()
-        )
+    start_time = await storage.offload(storage.active_fitness_sessions.get, user.id)
+    if start_time:
+        await REPLY_START_WITH_WORKOUT.send(update, time=start_time.strftime('%H:%M'))
     else:
-        await update.message.reply_text(
-            "Привет! Я бот для осознанности и тренировок. "
-            "Используй кнопки ниже, чтобы отмечать свою активность.",
-            reply_markup=main_menu()
-        )
+        await REPLY_START.send(update)
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /export — CSV, /export bin — колоночный файл; собирается порциями во временный файл вне цикла событий
+    user_id = update.effective_user.id
+    fmt = "bin" if context.args and context.args[0].lower() == "bin" else "csv"
+    write = EXPORT_FORMATS[fmt][0]
+
+    def build():
+        out = tempfile.TemporaryFile()
+        count = write(storage.iter_session_chunks(user_id), out)
+        out.seek(0)
+        return out, count
+
+    out, count = await asyncio.to_thread(build)
+    with out:
+        if not count:
+            await REPLY_EXPORT_EMPTY.send(update)
+            return
+        await update.message.reply_document(out, filename=f"chekamind_{user_id}.{fmt}", caption=f"📦 Сессий: {count}")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
@@ -156,92 +1988,112 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     text = update.message.text.strip()
     user_id = update.effective_user.id
-    state = storage.user_states.get(user_id, {})
+    await storage.ensure_user_async(user_id)
+    state = await storage.get_state(user_id)
 
-    # Обработка состояний
-    if state.get("awaiting_ai"):
-        await handle_ai_response(update, user_id, text)
-        return
-        
-    if state.get("awaiting_note"):
-        await handle_note_input(update, user_id, text)
-        return
-        
-    if state.get("awaiting_confirmation"):
-        await handle_note_confirmation(update, user_id, text)
-        return
-        
-    # Основные команды
-    if text == "💡 Задание":
-        await send_random_task(update)
-    elif text == "📅 Рефлексия":
-        await send_random_reflection(update)
-    elif text == "✨ Я осознан!":
-        await start_mindfulness_session(update, user_id)
-    elif text == "⏱ Начать тренировку":
-        await start_workout_session(update, user_id)
-    elif text == "🏁 Закончить тренировку":
-        await finish_workout_session(update, user_id)
-    elif text == "🧠 Поговорить с ИИ":
-        await start_ai_conversation(update, user_id)
-    elif text == "📊 Статистика":
-        await show_statistics_menu(update, user_id)
-    elif text == "🔙 Назад":
-        await return_to_main_menu(update, user_id)
-    else:
-        await handle_statistics_menus(update, user_id, text, state)
+    # Один поиск по таблице переходов вместо цепочки проверок
+    handler = ROUTES.get((state.state, text)) or FALLBACK_ROUTES[state.state]
+    if state is IDLE and storage.user_states.consume_expired(user_id) and handler is ask_use_menu:
+        handler = reply_session_expired
+    started = time.perf_counter()
+    try:
+        await handler(update, user_id, text, state)
+    except Exception:
+        HANDLER_ERRORS.inc(handler.__name__)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, handler.__name__)
+
+# ==================== СОСТОЯНИЯ ДИАЛОГА ====================
+class State(Enum):
+    MAIN = "main"
+    NOTE_CONFIRMATION = "note_confirmation"
+    NOTE_INPUT = "note_input"
+    AI_PROMPT = "ai_prompt"
+    STAT_CATEGORY = "stat_category"
+    STAT_PERIOD = "stat_period"
+
+class UserState:
+    __slots__ = ("state", "session_type", "session_time", "duration", "stat_category", "touched")
+
+    def __init__(self, state: State, session_type: str = None, session_time: datetime = None,
+                 duration: timedelta = None, stat_category: str = None):
+        self.state = state
+        self.session_type = session_type
+        self.session_time = session_time
+        self.duration = duration
+        self.stat_category = stat_category
+        self.touched = 0.0  # time.monotonic() последнего обращения, ведёт UserStateStore
+
+    def to_json(self) -> str:
+        return json.dumps([
+            self.state.value, self.session_type,
+            self.session_time.timestamp() if self.session_time else None,
+            self.duration.total_seconds() if self.duration else None,
+            self.stat_category
+        ])
+
+    @classmethod
+    def from_json(cls, data: str) -> "UserState":
+        state, session_type, session_ts, duration, stat_category = json.loads(data)
+        return cls(
+            State(state), session_type,
+            datetime.fromtimestamp(session_ts, MOSCOW_TZ) if session_ts is not None else None,
+            timedelta(seconds=duration) if duration is not None else None,
+            stat_category
+        )
+
+IDLE = UserState(State.MAIN)  # общее состояние для всех без активного диалога, не изменяется
 
 # ==================== ОБРАБОТКА СОСТОЯНИЙ ====================
-async def handle_ai_response(update: Update, user_id: int, text: str):
-    if text == "❌ Отмена":
-        storage.user_states.pop(user_id, None)
-        await update.message.reply_text("Общение с ИИ отменено.", reply_markup=main_menu())
-        return
-        
-    await update.message.reply_text("🧠 Думаю...")
-    response = await get_ai_response(text)
-    storage.user_states.pop(user_id, None)
-    await update.message.reply_text(response, reply_markup=main_menu())
+async def handle_ai_response(update: Update, user_id: int, text: str, state: UserState):
+    # Ответ проявляется в сообщении-заглушке по мере генерации
+    placeholder = await REPLY_THINKING.send(update)
+    editor = ThrottledEditor(placeholder)
+    response = await get_ai_response(text, on_partial=editor.update)
+    await storage.clear_state(user_id)
+    if not await editor.finish(response):
+        await update.message.reply_text(response, reply_markup=MAIN_MENU)
+
+async def cancel_ai_conversation(update: Update, user_id: int, text: str, state: UserState):
+    await storage.clear_state(user_id)
+    await REPLY_AI_CANCELLED.send(update)
 
-async def handle_note_input(update: Update, user_id: int, text: str):
-    state = storage.user_states[user_id]
+async def handle_note_input(update: Update, user_id: int, text: str, state: UserState):
     note = "Без заметки" if text in ["❌ Пропустить заметку", "🔄 Отменить"] else text
     
-    if state["session_type"] == "mindfulness":
-        storage.mindfulness_sessions.setdefault(user_id, []).append({
-            "time": state["session_time"],
+    if state.session_type == "mindfulness":
+        storage.add_session("mindfulness", user_id, {
+            "time": state.session_time,
             "note": note
         })
     else:  # fitness
-        storage.fitness_sessions.setdefault(user_id, []).append({
-            "time": state["session_time"],
+        storage.add_session("fitness", user_id, {
+            "time": state.session_time,
             "note": note,
-            "duration_seconds": int(state["duration"].total_seconds()) if state["duration"] else None
+            "duration_seconds": int(state.duration.total_seconds()) if state.duration else None
         })
     
-    storage.user_states.pop(user_id, None)
-    message = f"✅ Заметка сохранена: «{note}»" if note != "Без заметки" else "Сессия сохранена без заметки."
-    await update.message.reply_text(message, reply_markup=main_menu())
-
-async def handle_note_confirmation(update: Update, user_id: int, text: str):
-    state = storage.user_states[user_id]
-    
-    if text == "📝 Записать заметку":
-        storage.user_states[user_id] = {
-            "awaiting_note": True,
-            "session_type": state["session_type"],
-            "session_time": state["session_time"],
-            "duration": state.get("duration")
-        }
-        await update.message.reply_text("Напишите заметку:", reply_markup=note_input_menu())
-    elif text == "❌ Отменить":
-        storage.user_states.pop(user_id, None)
-        await update.message.reply_text("Действие отменено.", reply_markup=main_menu())
+    await storage.clear_state(user_id)
+    if note != "Без заметки":
+        await REPLY_NOTE_SAVED.send(update, note=note)
     else:
-        await update.message.reply_text("Пожалуйста, выберите действие.", reply_markup=note_confirmation_menu())
+        await REPLY_SAVED_WITHOUT_NOTE.send(update)
+
+async def start_note_input(update: Update, user_id: int, text: str, state: UserState):
+    state.state = State.NOTE_INPUT
+    await storage.set_state(user_id, state)
+    await REPLY_ENTER_NOTE.send(update)
+
+async def cancel_note(update: Update, user_id: int, text: str, state: UserState):
+    await storage.clear_state(user_id)
+    await REPLY_CANCELLED.send(update)
+
+async def ask_note_confirmation(update: Update, user_id: int, text: str, state: UserState):
+    await REPLY_CHOOSE_ACTION.send(update)
 
 # ==================== ОСНОВНЫЕ КОМАНДЫ ====================
-async def send_random_task(update: Update):
+async def send_random_task(update: Update, user_id: int, text: str, state: UserState):
     tasks = [
         "Задача: остановись на 60 секунд и почувствуй тело.",
         "Задача: сделай 10 глубоких вдохов.",
@@ -249,167 +2101,249 @@ async def send_random_task(update: Update):
     ]
     await update.message.reply_text(random.choice(tasks))
 
-async def send_random_reflection(update: Update):
+async def send_random_reflection(update: Update, user_id: int, text: str, state: UserState):
     reflections = [
         "Рефлексия: что ты заметил сегодня?",
         "Рефлексия: чего ты добился на этой неделе?"
     ]
     await update.message.reply_text(random.choice(reflections))
 
-async def start_mindfulness_session(update: Update, user_id: int):
-    storage.user_states[user_id] = {
-        "awaiting_confirmation": True,
-        "session_type": "mindfulness",
-        "session_time": now_moscow(),
-        "duration": None
-    }
-    await update.message.reply_text("Хотите записать заметку об осознанности?", reply_markup=note_confirmation_menu())
+async def start_mindfulness_session(update: Update, user_id: int, text: str, state: UserState):
+    await storage.set_state(user_id, UserState(State.NOTE_CONFIRMATION, "mindfulness", now_moscow()))
+    await REPLY_ASK_MINDFULNESS_NOTE.send(update)
 
-async def start_workout_session(update: Update, user_id: int):
-    if user_id in storage.active_fitness_sessions:
-        await update.message.reply_text("Тренировка уже запущена! Сначала завершите текущую.", reply_markup=main_menu())
+async def start_workout_session(update: Update, user_id: int, text: str, state: UserState):
+    if await storage.offload(storage.active_fitness_sessions.get, user_id):
+        await REPLY_WORKOUT_ALREADY_STARTED.send(update)
         return
         
     start_time = now_moscow()
-    storage.active_fitness_sessions[user_id] = start_time
-    storage.user_states[user_id] = {
-        "awaiting_confirmation": True,
-        "session_type": "fitness",
-        "session_time": start_time,
-        "duration": None
-    }
-    await update.message.reply_text(
-        f"✅ Тренировка начата в {start_time.strftime('%H:%M')}!",
-        reply_markup=note_confirmation_menu()
-    )
+    await storage.offload(storage.start_active_session, user_id, start_time)
+    schedule_auto_finish(user_id, start_time)
+    await storage.set_state(user_id, UserState(State.NOTE_CONFIRMATION, "fitness", start_time))
+    await REPLY_WORKOUT_STARTED.send(update, time=start_time.strftime('%H:%M'))
 
-async def finish_workout_session(update: Update, user_id: int):
-    start_time = storage.active_fitness_sessions.pop(user_id, None)
+async def finish_workout_session(update: Update, user_id: int, text: str, state: UserState):
+    start_time = await storage.offload(storage.finish_active_session, user_id)
+    scheduler.cancel(("auto_finish", user_id))
     if not start_time:
-        await update.message.reply_text("Тренировка не была начата.", reply_markup=main_menu())
+        await REPLY_WORKOUT_NOT_STARTED.send(update)
         return
         
     duration = now_moscow() - start_time
-    storage.user_states[user_id] = {
-        "awaiting_confirmation": True,
-        "session_type": "fitness",
-        "session_time": start_time,
-        "duration": duration
-    }
-    await update.message.reply_text(
-        f"🎉 Тренировка завершена!\n"
-        f"⏱ Длительность: {str(duration).split('.')[0]}\n"
-        "Хотите записать заметку?",
-        reply_markup=note_confirmation_menu()
-    )
+    await storage.set_state(user_id, UserState(State.NOTE_CONFIRMATION, "fitness", start_time, duration))
+    await REPLY_WORKOUT_FINISHED.send(update, duration=str(duration).split('.')[0])
 
-async def start_ai_conversation(update: Update, user_id: int):
-    storage.user_states[user_id] = {"awaiting_ai": True}
-    await update.message.reply_text(
-        "💭 Напиши, что тебя волнует. Я постараюсь помочь с позиции осознанности.",
-        reply_markup=cancel_menu()
-    )
+async def start_ai_conversation(update: Update, user_id: int, text: str, state: UserState):
+    await storage.set_state(user_id, UserState(State.AI_PROMPT))
+    await REPLY_AI_PROMPT.send(update)
 
-async def show_statistics_menu(update: Update, user_id: int):
-    storage.user_states[user_id] = {"menu": "stat_category"}
-    await update.message.reply_text("Выберите категорию статистики:", reply_markup=stats_category_menu())
+async def show_statistics_menu(update: Update, user_id: int, text: str, state: UserState):
+    await storage.set_state(user_id, UserState(State.STAT_CATEGORY))
+    await REPLY_STATS_CATEGORY.send(update)
 
-async def return_to_main_menu(update: Update, user_id: int):
-    storage.user_states.pop(user_id, None)
-    await update.message.reply_text("Главное меню:", reply_markup=main_menu())
+async def return_to_main_menu(update: Update, user_id: int, text: str, state: UserState):
+    await storage.clear_state(user_id)
+    await REPLY_MAIN_MENU.send(update)
+
+async def reply_session_expired(update: Update, user_id: int, text: str, state: UserState):
+    await REPLY_SESSION_EXPIRED.send(update)
+
+async def ask_use_menu(update: Update, user_id: int, text: str, state: UserState):
+    await REPLY_USE_MENU.send(update)
 
 # ==================== ОБРАБОТКА СТАТИСТИКИ ====================
-async def handle_statistics_menus(update: Update, user_id: int, text: str, state: dict):
-    if state.get("menu") == "stat_category":
-        await handle_stat_category(update, user_id, text)
-    elif state.get("menu") == "stat_period":
-        await handle_stat_period(update, user_id, text, state)
-    else:
-        await update.message.reply_text("Пожалуйста, используйте кнопки меню.", reply_markup=main_menu())
-
-async def handle_stat_category(update: Update, user_id: int, text: str):
-    if text == "📊 Статистика по осознанности":
-        storage.user_states[user_id] = {"menu": "stat_period", "stat_category": "mindfulness"}
-        await update.message.reply_text("Выберите период:", reply_markup=stats_period_menu())
-    elif text == "📊 Статистика по спорту":
-        storage.user_states[user_id] = {"menu": "stat_period", "stat_category": "fitness"}
-        await update.message.reply_text("Выберите период:", reply_markup=stats_period_menu())
-    else:
-        await update.message.reply_text("Выберите из меню.", reply_markup=stats_category_menu())
+STAT_CATEGORIES = {
+    "📊 Статистика по осознанности": "mindfulness",
+    "📊 Статистика по спорту": "fitness"
+}
+STAT_PERIOD_DAYS = {
+    "📅 За день": 1,
+    "📆 За неделю": ActivityCounters.KEEP_DAYS
+}
 
-async def handle_stat_period(update: Update, user_id: int, text: str, state: dict):
-    if text == "🔙 Назад":
-        storage.user_states[user_id] = {"menu": "stat_category"}
-        await update.message.reply_text("Выберите категорию:", reply_markup=stats_category_menu())
-        return
-        
+async def handle_stat_category(update: Update, user_id: int, text: str, state: UserState):
+    await storage.set_state(user_id, UserState(State.STAT_PERIOD, stat_category=STAT_CATEGORIES[text]))
+    await REPLY_STATS_PERIOD.send(update)
+
+async def ask_stat_category(update: Update, user_id: int, text: str, state: UserState):
+    await REPLY_CHOOSE_CATEGORY.send(update)
+
+async def back_to_stat_category(update: Update, user_id: int, text: str, state: UserState):
+    await storage.set_state(user_id, UserState(State.STAT_CATEGORY))
+    await REPLY_STATS_BACK_TO_CATEGORY.send(update)
+
+async def ask_stat_period(update: Update, user_id: int, text: str, state: UserState):
+    await REPLY_CHOOSE_PERIOD.send(update)
+
+async def handle_stat_period(update: Update, user_id: int, text: str, state: UserState):
     now = now_moscow()
-    if text == "📅 За день":
-        period_start = now - timedelta(days=1)
-    elif text == "📆 За неделю":
-        period_start = now - timedelta(days=7)
-    else:
-        await update.message.reply_text("Выберите из меню.", reply_markup=stats_period_menu())
-        return
+    today = ActivityCounters.day_of(now)
+    first_day = today - STAT_PERIOD_DAYS[text] + 1
+    period_start = datetime.combine(date.fromordinal(first_day), datetime.min.time(), MOSCOW_TZ)
 
-    cat = state["stat_category"]
-    sessions = storage.mindfulness_sessions if cat == "mindfulness" else storage.fitness_sessions
-    user_sessions = sessions.get(user_id, [])
+    # Итоги периода — по бинарному поиску и префиксным суммам, без обхода записей
+    cat = state.stat_category
+    series = (storage.mindfulness_sessions if cat == "mindfulness" else storage.fitness_sessions).get(user_id)
+    lo, hi = series.span(period_start) if series else (0, 0)
+    total = hi - lo
+    seconds = series.total_duration(lo, hi) if series else 0
     title = "осознанности" if cat == "mindfulness" else "спорта"
 
-    filtered = [s for s in user_sessions if s["time"] >= period_start]
-    if not filtered:
-        await update.message.reply_text(f"За выбранный период нет данных по {title}.", reply_markup=main_menu())
-        storage.user_states.pop(user_id, None)
+    if not total:
+        await REPLY_NO_STATS.send(update, title=title)
+        await storage.clear_state(user_id)
+        return
+
+    # Записи рендерим только для первой страницы
+    await storage.clear_state(user_id)
+    summary = format_statistics_summary(title, total, seconds if cat == "fitness" else 0, period_start, now)
+    text, markup = render_statistics_page(user_id, cat, first_day, today, 0)
+    if markup is None:
+        await update.message.reply_text(summary + text, reply_markup=MAIN_MENU, parse_mode="Markdown")
         return
+    await update.message.reply_text(summary, reply_markup=MAIN_MENU, parse_mode="Markdown")
+    await update.message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
 
-    msg = format_statistics_message(filtered, period_start, now, title, cat)
-    storage.user_states.pop(user_id, None)
-    await update.message.reply_text(msg, reply_markup=main_menu(), parse_mode="Markdown")
+async def handle_stats_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Листание: callback_data "stats:<категория>:<первый день>:<последний день>:<страница>"
+    query = update.callback_query
+    _, cat, first_day, last_day, page = query.data.split(":")
+    await storage.ensure_user_async(update.effective_user.id)
+    text, markup = render_statistics_page(update.effective_user.id, cat, int(first_day), int(last_day), int(page))
+    await query.answer()
+    try:
+        await query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
 
-def format_statistics_message(sessions, period_start, now, title, cat):
+def format_statistics_summary(title, total, seconds, period_start, now):
     msg = (f"📊 *Статистика по {title}* за период с {period_start.strftime('%d.%m.%Y')} "
-           f"по {now.strftime('%d.%m.%Y')}:\n🔢 Всего сессий: {len(sessions)}\n\n")
-    
-    for s in sessions:
-        time_str = s["time"].strftime("%d.%m %H:%M")
-        note = s.get("note", "").strip()
-        dur = s.get("duration_seconds")
-        dur_str = f"⏱ {format_duration(dur)}" if dur else ""
-
-        entry = f"🔹 *{time_str}*"
-        if dur_str:
-            entry += f" | {dur_str}"
-        entry += "\n"
-        if note and note != "Без заметки":
-            entry += f"  📝 _{note}_"
-        else:
-            entry += f"  💬 _Без заметки_"
-        msg += entry + "\n\n"
-    
-    return msg
+           f"по {now.strftime('%d.%m.%Y')}:\n🔢 Всего сессий: {total}\n")
+    if seconds:
+        msg += f"⏱ Общее время: {format_duration(seconds)}\n"
+    return msg + "\n"
+
+def telegram_len(text: str) -> int:
+    # Длина так, как её считает Telegram — в единицах UTF-16
+    return len(text.encode("utf-16-le")) // 2
+
+def shorten_note(note: str) -> str:
+    # Экранирует Markdown и обрезает так, чтобы экранированный текст не превышал лимит
+    escaped = escape_markdown(note)
+    if telegram_len(escaped) <= STATS_NOTE_MAX_CHARS:
+        return escaped
+    limit = STATS_NOTE_MAX_CHARS - 1  # место под «…»
+    cut = limit
+    escaped = escape_markdown(note[:cut])
+    while telegram_len(escaped) > limit:
+        cut -= max(1, (telegram_len(escaped) - limit + 1) // 2)
+        escaped = escape_markdown(note[:cut])
+    return escaped + "…"
+
+def format_statistics_entry(s):
+    time_str = s["time"].strftime("%d.%m %H:%M")
+    note = s.get("note", "").strip()
+    dur = s.get("duration_seconds")
+    dur_str = f" | ⏱ {format_duration(dur)}" if dur else ""
+
+    if note and note != "Без заметки":
+        return f"🔹 *{time_str}*{dur_str}\n  📝 _{shorten_note(note)}_\n\n"
+    return f"🔹 *{time_str}*{dur_str}\n  💬 _Без заметки_\n\n"
+
+def render_statistics_page(user_id: int, cat: str, first_day: int, last_day: int, page: int):
+    # Рендерим только видимый срез; кнопки листания — если страниц больше одной
+    sessions = storage.mindfulness_sessions if cat == "mindfulness" else storage.fitness_sessions
+    series = sessions.get(user_id)
+    period_start = datetime.combine(date.fromordinal(first_day), datetime.min.time(), MOSCOW_TZ)
+    lo, hi = series.span(period_start, period_start + timedelta(days=last_day - first_day + 1)) if series else (0, 0)
+    pages = max(1, -(-(hi - lo) // STATS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = lo + page * STATS_PAGE_SIZE
+    text = "".join(map(format_statistics_entry, series.sessions(start, min(hi, start + STATS_PAGE_SIZE)))) \
+        if series else ""
+    if pages == 1:
+        return text or "Нет записей.", None
+
+    prefix = f"stats:{cat}:{first_day}:{last_day}:"
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{prefix}{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons])
+
+# ==================== МАРШРУТИЗАЦИЯ ====================
+# Кнопки главного меню работают в главном меню и в меню статистики
+MAIN_MENU_ROUTES = {
+    "💡 Задание": send_random_task,
+    "📅 Рефлексия": send_random_reflection,
+    "✨ Я осознан!": start_mindfulness_session,
+    "⏱ Начать тренировку": start_workout_session,
+    "🏁 Закончить тренировку": finish_workout_session,
+    "🧠 Поговорить с ИИ": start_ai_conversation,
+    "📊 Статистика": show_statistics_menu,
+    "🔙 Назад": return_to_main_menu
+}
+MENU_STATES = (State.MAIN, State.STAT_CATEGORY, State.STAT_PERIOD)
+
+# Переходы конкретного состояния; перекрывают кнопки главного меню
+STATE_ROUTES = {
+    State.NOTE_CONFIRMATION: {"📝 Записать заметку": start_note_input, "❌ Отменить": cancel_note},
+    State.AI_PROMPT: {"❌ Отмена": cancel_ai_conversation},
+    State.STAT_CATEGORY: {button: handle_stat_category for button in STAT_CATEGORIES},
+    State.STAT_PERIOD: {"🔙 Назад": back_to_stat_category,
+                        **{button: handle_stat_period for button in STAT_PERIOD_DAYS}}
+}
+
+# Любой другой текст в состоянии
+FALLBACK_ROUTES = {
+    State.MAIN: ask_use_menu,
+    State.NOTE_CONFIRMATION: ask_note_confirmation,
+    State.NOTE_INPUT: handle_note_input,
+    State.AI_PROMPT: handle_ai_response,
+    State.STAT_CATEGORY: ask_stat_category,
+    State.STAT_PERIOD: ask_stat_period
+}
+
+def build_routes() -> dict:
+    routes = {}
+    for state in MENU_STATES:
+        routes.update({(state, button): handler for button, handler in MAIN_MENU_ROUTES.items()})
+    for state, buttons in STATE_ROUTES.items():
+        routes.update({(state, button): handler for button, handler in buttons.items()})
+    return routes
+
+ROUTES = build_routes()
 
 # ==================== ФОНОВЫЕ ЗАДАЧИ ====================
-async def fitness_auto_finish_checker(app):
-    while True:
-        now = now_moscow()
-        for user_id, start_time in list(storage.active_fitness_sessions.items()):
-            if now - start_time > timedelta(hours=AUTO_FINISH_HOURS):
-                duration = int((now - start_time).total_seconds())
-                storage.fitness_sessions.setdefault(user_id, []).append({
-                    "time": start_time,
-                    "note": "Авто-завершение",
-                    "duration_seconds": duration
-                })
-                del storage.active_fitness_sessions[user_id]
-                try:
-                    await app.bot.send_message(
-                        user_id,
-                        f"⏳ Тренировка автоматически завершена после {AUTO_FINISH_HOURS} часов"
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления: {e}")
-        await asyncio.sleep(AUTO_FINISH_CHECK_SECONDS)
+def schedule_auto_finish(user_id: int, start_time: datetime):
+    deadline = start_time + timedelta(hours=AUTO_FINISH_HOURS)
+    scheduler.schedule(("auto_finish", user_id), deadline, partial(auto_finish_workout, user_id, start_time))
+
+async def auto_finish_workout(user_id: int, start_time: datetime):
+    if not await storage.offload(storage.claim_active_session, user_id, start_time):
+        return
+    await storage.ensure_user_async(user_id)
+    storage.add_session("fitness", user_id, {
+        "time": start_time,
+        "note": "Авто-завершение",
+        "duration_seconds": AUTO_FINISH_HOURS * 3600
+    })
+    await broadcaster.send(user_id, f"⏳ Тренировка автоматически завершена после {AUTO_FINISH_HOURS} часов")
+
+def daily_report_messages(day_totals: dict):
+    for user_id, totals in day_totals.items():
+        mindful_today, fitness_today, total_duration = totals
+        if mindful_today or fitness_today:
+            yield user_id, (
+                f"🌙 *Ежедневный отчёт*\n\n"
+                f"✨ Осознанность: {mindful_today} раз\n"
+                f"🏋️‍♂️ Тренировок: {fitness_today}\n"
+                f"⏱ Время тренировок: {format_duration(total_duration)}"
+            )
 
 async def daily_report(app):
     while True:
@@ -419,74 +2353,521 @@ async def daily_report(app):
             target += timedelta(days=1)
         await asyncio.sleep((target - now).total_seconds())
 
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        for user_id in list(storage.mindfulness_sessions.keys()):
-            mindful_today = len([s for s in storage.mindfulness_sessions.get(user_id, []) 
-                              if s["time"] >= today_start])
-            fitness_today = [s for s in storage.fitness_sessions.get(user_id, []) 
-                           if s["time"] >= today_start]
-            total_duration = sum(s.get("duration_seconds", 0) for s in fitness_today)
+        # В кластере отчёт рассылает только лидер, по счётчикам из общей базы
+        if not cluster.is_leader:
+            continue
 
-            if mindful_today or fitness_today:
-                try:
-                    await app.bot.send_message(
-                        user_id,
-                        f"🌙 *Ежедневный отчёт*\n\n"
-                        f"✨ Осознанность: {mindful_today} раз\n"
-                        f"🏋️‍♂️ Тренировок: {len(fitness_today)}\n"
-                        f"⏱ Время тренировок: {format_duration(total_duration)}",
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка отправки отчёта: {e}")
+        # Рассылка — отдельная работа: остановка бота даёт ей дойти до конца
+        started = time.perf_counter()
+        await asyncio.shield(supervisor.spawn(send_daily_report(), name="daily_report:send"))
+        LOOP_TICK_SECONDS.observe(time.perf_counter() - started, "daily_report")
+
+async def send_daily_report() -> BroadcastReport:
+    # Итоги дня уже посчитаны в счётчиках — обходим только активных сегодня
+    day_totals = await storage.day_totals(ActivityCounters.day_of(now_moscow()))
+    return await broadcaster.broadcast(daily_report_messages(day_totals), name="Ежедневный отчёт",
+                                       parse_mode="Markdown")
+
+async def storage_flush_loop():
+    # Группируем записи в транзакции: раз в STORAGE_FLUSH_SECONDS или по заполнению буфера
+    while True:
+        try:
+            await asyncio.wait_for(storage.flush_requested.wait(), STORAGE_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        storage.flush_requested.clear()
+        started = time.perf_counter()
+        try:
+            await storage.backend.flush_async()
+            await storage.user_states.sweep_async()
+        except Exception as e:
+            logger.error(f"Ошибка записи в хранилище: {e}")
+        LOOP_TICK_SECONDS.observe(time.perf_counter() - started, "storage_flush")
+
+# ==================== ПРИЁМ ОБНОВЛЕНИЙ ====================
+class UpdateIngress:
+    # Webhook на aiohttp-сервере: каждое принятое обновление сразу запускается задачей,
+    # дальше его ведёт UserLaneUpdateProcessor — очередь пользователя, затем общий лимит.
+    # Ожидание своей полосы ничего не занимает, поэтому долгий запрос одного пользователя
+    # не задерживает остальных. Принятых, но не обработанных обновлений не больше max_pending,
+    # сверх этого отвечаем 503 — Telegram повторит доставку.
+    def __init__(self, application, max_pending: int = UPDATE_QUEUE_SIZE, secret: str = WEBHOOK_SECRET):
+        self.application = application
+        self.max_pending = max_pending
+        self.secret = secret
+        self.accepting = False
+        self.received = self.processed = self.failed = self.rejected = 0
+        self.max_depth = 0
+        self._tasks = set()
+
+    async def handle_webhook(self, request):
+        if not self.secret or request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        if not self.accepting or len(self._tasks) >= self.max_pending:
+            self.rejected += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.received += 1
+        self.max_depth = max(self.max_depth, len(self._tasks))
+        return web.Response()
+
+    def start(self):
+        self.accepting = True
+
+    async def stop(self, deadline: float = 0):
+        # Новые не принимаем, уже принятым даём доработать до дедлайна
+        self.accepting = False
+        if self._tasks and deadline:
+            await asyncio.wait(set(self._tasks), timeout=deadline)
+        if self._tasks:
+            logger.warning(f"Не обработано обновлений: {len(self._tasks)}")
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _process(self, update: Update):
+        try:
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка обработки обновления: {e}")
+
+    def metrics(self) -> dict:
+        return {
+            "pending": len(self._tasks),
+            "max_pending": self.max_pending,
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected
+        }
+
+class UserLaneUpdateProcessor(BaseUpdateProcessor):
+    # Обновления одного пользователя обрабатываются строго по очереди, разных — параллельно.
+    # Полоса живёт, пока в ней есть ожидающие обновления, и сразу удаляется после.
+    # Слот общего лимита берётся уже внутри полосы: очередь одного пользователя
+    # не занимает слоты, пока ждёт своей очереди, и не мешает остальным.
+    __slots__ = ("_lanes", "peak_lanes")
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._lanes = {}  # user_id -> [asyncio.Lock, число обновлений в полосе]
+        self.peak_lanes = 0
+
+    @property
+    def active_lanes(self) -> int:
+        return len(self._lanes)
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        try:
+            if user is None:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+                return
+            await self.run_in_lane(user.id, self._route(update, coroutine))
+        finally:
+            coroutine.close()  # отменённое в ожидании очереди так и не запустилось
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def _route(self, update, coroutine):
+        # Пользователей другого узла отдаём владельцу; если он недоступен — обрабатываем сами
+        if not cluster.owns(update.effective_user.id) and await cluster.forward(update):
+            coroutine.close()
+            return
+        await coroutine
+
+    async def run_in_lane(self, user_id: int, coroutine):
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = [asyncio.Lock(), 0]
+            self.peak_lanes = max(self.peak_lanes, len(self._lanes))
+        lane[1] += 1
+        try:
+            async with lane[0], self._semaphore:
+                await coroutine
+        finally:
+            coroutine.close()
+            lane[1] -= 1
+            if not lane[1]:
+                del self._lanes[user_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ==================== КЛАСТЕР ====================
+class HashRing:
+    # Консистентное хеширование: при смене состава узлов переезжает лишь ~1/N пользователей
+    def __init__(self, nodes, replicas: int = 64):
+        self._points = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def owner(self, user_id: int) -> str:
+        i = bisect_right(self._keys, self._hash(str(user_id))) % len(self._keys)
+        return self._points[i][1]
+
+def parse_cluster_nodes(spec: str) -> dict:
+    nodes = {}
+    for item in spec.split(","):
+        node_id, _, url = item.strip().partition("=")
+        if node_id and url:
+            nodes[node_id] = url.rstrip("/")
+    return nodes
+
+class Cluster:
+    # Несколько процессов бота: пользователи закреплены за узлами по кольцу,
+    # общее состояние лежит в SQLite, рассылки и поллинг выполняет лидер.
+    FORWARD_PATH = "/cluster/update"
+
+    def __init__(self, node_id: str = CLUSTER_NODE_ID, nodes: str = CLUSTER_NODES, secret: str = CLUSTER_SECRET,
+                 forward_timeout: float = CLUSTER_FORWARD_TIMEOUT_SECONDS):
+        self.nodes = parse_cluster_nodes(nodes)  # node_id -> базовый URL
+        self.node_id = node_id
+        self.enabled = bool(node_id) and node_id in self.nodes
+        self.secret = secret
+        self.forward_timeout = forward_timeout
+        self.ring = HashRing(self.nodes) if self.enabled else None
+        self.is_leader = not self.enabled
+        self.on_leadership_change = None  # async callback(is_leader)
+        self.application = None
+        self.session = None
+        self.forwarded = self.forward_failed = self.received = 0
+
+    def owns(self, user_id: int) -> bool:
+        return not self.enabled or self.ring.owner(user_id) == self.node_id
+
+    async def start(self, application):
+        self.application = application
+        # Общего таймаута нет: узел-владелец отвечает, когда обработает обновление, но
+        # зависший узел не должен держать пересылку вечно — ограничиваем ожидание ответа
+        self.session = ClientSession(timeout=ClientTimeout(total=None, sock_connect=2, sock_read=self.forward_timeout))
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def forward(self, update: Update) -> bool:
+        owner = self.ring.owner(update.effective_user.id)
+        try:
+            async with self.session.post(
+                self.nodes[owner] + self.FORWARD_PATH,
+                json=update.to_dict(),
+                headers={"X-Cluster-Secret": self.secret or ""}
+            ) as resp:
+                if resp.status != 200:
+                    logger.warning(f"Узел {owner} не принял обновление: HTTP {resp.status}")
+                    self.forward_failed += 1
+                    # 4xx — узел отверг обновление до обработки, 5xx — упал во время неё
+                    return resp.status >= 500
+        except (ClientOSError, ConnectionTimeoutError) as e:
+            # Узел не запущен или запрос не ушёл — обновление не обработано, обрабатываем сами
+            logger.warning(f"Узел {owner} недоступен: {e}")
+            self.forward_failed += 1
+            return False
+        except ClientError as e:
+            # Соединение оборвалось в процессе или узел не ответил за forward_timeout:
+            # повторная обработка могла бы продублировать ответ
+            logger.error(f"Ошибка пересылки на узел {owner}: {e}")
+            self.forward_failed += 1
+            return True
+        self.forwarded += 1
+        return True
+
+    async def handle_forwarded_update(self, request):
+        if not self.secret or request.headers.get("X-Cluster-Secret") != self.secret:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        self.received += 1
+        # Сразу в полосу пользователя: повторно по кольцу не маршрутизируем
+        await self.application.update_processor.run_in_lane(
+            update.effective_user.id, self.application.process_update(update)
+        )
+        return web.Response()
+
+    async def run_election(self, backend: SQLiteBackend):
+        # Аренда в общей базе: продлеваем каждую треть срока, при падении лидера
+        # её заберёт другой узел после истечения. Своя аренда "node:<id>" у каждого
+        # узла — пульс, по которому лидер узнаёт упавших
+        while True:
+            try:
+                await asyncio.to_thread(
+                    backend.try_acquire_lease, f"node:{self.node_id}", self.node_id, CLUSTER_LEASE_SECONDS
+                )
+                leader = await asyncio.to_thread(
+                    backend.try_acquire_lease, "leader", self.node_id, CLUSTER_LEASE_SECONDS
+                )
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка продления аренды лидера: {e}")
+                leader = False
+            if leader != self.is_leader:
+                self.is_leader = leader
+                logger.info(f"Узел {self.node_id}: {'лидер' if leader else 'ведомый'}")
+                if self.on_leadership_change:
+                    await self.on_leadership_change(leader)
+            await asyncio.sleep(CLUSTER_LEASE_SECONDS / 3)
+
+    def metrics(self) -> dict:
+        return {
+            "cluster_node": self.node_id,
+            "cluster_nodes": len(self.nodes),
+            "cluster_leader": int(self.is_leader),
+            "cluster_forwarded": self.forwarded,
+            "cluster_forward_failed": self.forward_failed,
+            "cluster_received": self.received
+        }
+
+cluster = Cluster()
+
+async def cluster_sync_loop():
+    # Каждый узел подхватывает тренировки своих пользователей, начатые другим узлом,
+    # пока он был недоступен; лидер — ещё и тренировки узлов без живого пульса.
+    # Повторное срабатывание безопасно: завершает тот, кто первым заберёт запись.
+    while True:
+        await asyncio.sleep(CLUSTER_SYNC_SECONDS)
+        started = time.perf_counter()
+        active = await asyncio.to_thread(storage.backend.load_active_sessions)
+        alive = await asyncio.to_thread(storage.backend.live_lease_holders, "node:") if cluster.is_leader else set()
+        for user_id, start_time in active.items():
+            owner = cluster.ring.owner(user_id)
+            if owner != cluster.node_id and (not cluster.is_leader or owner in alive):
+                continue
+            if ("auto_finish", user_id) not in scheduler:
+                schedule_auto_finish(user_id, start_time)
+        LOOP_TICK_SECONDS.observe(time.perf_counter() - started, "cluster_sync")
 
 # ==================== ВЕБ-СЕРВЕР ДЛЯ PING ====================
+INGRESS_KEY = web.AppKey("ingress", UpdateIngress)
+
 async def handle_root(request):
     return web.Response(text="🧘 Mindfulness Bot is alive!")
 
 async def handle_health(request):
-    return web.Response(text="OK", status=200)
+    ingress = request.app.get(INGRESS_KEY)
+    lines = ["OK"]
+    if ingress is not None:
+        lines += [f"{name} {value}" for name, value in ingress.metrics().items()]
+        processor = ingress.application.update_processor
+        if isinstance(processor, UserLaneUpdateProcessor):
+            lines += [f"active_lanes {processor.active_lanes}", f"peak_lanes {processor.peak_lanes}"]
+    if isinstance(storage.user_states, UserStateStore):
+        lines += [f"{name} {value}" for name, value in storage.user_states.stats().items()]
+    if cluster.enabled:
+        lines += [f"{name} {value}" for name, value in cluster.metrics().items()]
+    return web.Response(text="\n".join(lines), status=200)
+
+async def handle_metrics(request):
+    return web.Response(
+        body=(await metrics.collect()).encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def handle_ai_metrics(request):
+    return web.json_response({**ai_client.metrics(), "cache": ai_cache.stats()})
 
-async def run_webserver():
+async def run_webserver(ingress: UpdateIngress = None):
     app = web.Application()
-    app.add_routes([web.get("/", handle_root), web.get("/health", handle_health)])
+    app.add_routes([web.get("/", handle_root), web.get("/health", handle_health),
+                    web.get("/metrics/ai", handle_ai_metrics)])
+    if METRICS_ENABLED:
+        app.add_routes([web.get("/metrics", handle_metrics)])
+    if ingress is not None:
+        app[INGRESS_KEY] = ingress
+        app.add_routes([web.post(WEBHOOK_PATH, ingress.handle_webhook)])
+    if cluster.enabled:
+        app.add_routes([web.post(Cluster.FORWARD_PATH, cluster.handle_forwarded_update)])
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
     logger.info(f"🌐 Веб-сервер запущен на порту {PORT}")
+    return runner
 
 # ==================== ЗАПУСК БОТА ====================
-async def main():
-    # Создаем Application и добавляем обработчики
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
-    
+def register_handlers(application):
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CallbackQueryHandler(handle_stats_page, pattern=r"^stats:"))
+
+async def main():
+    # Создаем Application и добавляем обработчики
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UserLaneUpdateProcessor())
+        .request(InstrumentedRequest(connection_pool_size=256))
+    )
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    application = builder.build()
+    register_handlers(application)
+    broadcaster.bot = application.bot
+
+    # Подключаем хранилище: в кластере все узлы работают с одним файлом SQLite
+    backend = create_storage_backend()
+    if cluster.enabled and not isinstance(backend, SQLiteBackend):
+        raise RuntimeError("Кластерный режим требует STORAGE_BACKEND=sqlite")
+    if cluster.enabled and not cluster.secret:
+        raise RuntimeError("Кластерный режим требует непустой CLUSTER_SECRET")
+    started = time.perf_counter()
+    if storage.open(backend, shared=cluster.enabled, snapshot_path=None if cluster.enabled else SNAPSHOT_PATH):
+        logger.info(f"💾 Состояние поднято из снимка за {(time.perf_counter() - started) * 1000:.0f} мс")
+    for user_id, start_time in storage.active_fitness_sessions.items():
+        if cluster.owns(user_id):
+            schedule_auto_finish(user_id, start_time)
+
+    # Без секрета вебхук принимал бы поддельные обновления от кого угодно.
+    # Одиночному узлу генерируем случайный, узлам кластера он нужен общий
+    webhook_secret = WEBHOOK_SECRET
+    if WEBHOOK_URL and not webhook_secret:
+        if cluster.enabled:
+            raise RuntimeError("Вебхук в кластере требует общий WEBHOOK_SECRET")
+        webhook_secret = secrets.token_urlsafe(32)
+        logger.warning("⚠️ WEBHOOK_SECRET не задан — сгенерирован случайный на время работы")
 
-    # Запускаем веб-сервер
-    await run_webserver()
+    # Запускаем веб-сервер и пул соединений к YandexGPT
+    ingress = UpdateIngress(application, secret=webhook_secret) if WEBHOOK_URL else None
+    runner = await run_webserver(ingress)
+    await ai_client.start()
+    if cluster.enabled:
+        await cluster.start(application)
 
     # Запускаем бота
     async with application:
+        supervisor.install_signal_handlers()
+
+        if cluster.enabled and not ingress:
+            # getUpdates допускает одного получателя — поллит только лидер. Обработчик
+            # ставим до запуска выборов, иначе первое избрание прошло бы без поллинга
+            async def toggle_polling(is_leader: bool):
+                if is_leader:
+                    await application.updater.start_polling()
+                elif application.updater.running:
+                    await application.updater.stop()
+            cluster.on_leadership_change = toggle_polling
+
         # Запускаем фоновые задачи
-        asyncio.create_task(fitness_auto_finish_checker(application))
-        asyncio.create_task(daily_report(application))
-        
+        supervisor.spawn_loop(scheduler.run(), name="scheduler")
+        supervisor.spawn_loop(daily_report(application), name="daily_report")
+        supervisor.spawn_loop(storage_flush_loop(), name="storage_flush")
+        if cluster.enabled:
+            supervisor.spawn_loop(cluster.run_election(backend), name="cluster_election")
+            supervisor.spawn_loop(cluster_sync_loop(), name="cluster_sync")
+
         # Запускаем бота
         await application.start()
-        
-        # Бесконечный цикл
+        if ingress:
+            ingress.start()
+            await application.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=webhook_secret,
+                max_connections=min(100, WEBHOOK_MAX_CONNECTIONS)
+            )
+        elif not cluster.enabled:
+            await application.updater.start_polling()
+
+        # Работаем до SIGTERM/SIGINT
         try:
-            while True:
-                await asyncio.sleep(3600)
-        except asyncio.CancelledError:
-            pass
+            await supervisor.stopping.wait()
         finally:
+            # Порядок остановки: перестаём принимать обновления, дорабатываем принятые
+            # и начатые задачи в пределах общего дедлайна, затем сохраняем память
+            logger.info("Остановка бота...")
+            deadline = time.monotonic() + SHUTDOWN_DEADLINE_SECONDS
+            await runner.cleanup()
+            if ingress:
+                await ingress.stop(max(0.0, deadline - time.monotonic()))
+            elif application.updater.running:
+                await application.updater.stop()
             await application.stop()
+            interrupted = await supervisor.drain(max(0.0, deadline - time.monotonic()))
+            if interrupted:
+                logger.warning(f"Прервано по дедлайну задач: {interrupted}")
+            await ai_client.close()
+            await cluster.close()
+            if not cluster.enabled:
+                storage.backend.flush()
+                storage.save_snapshot(SNAPSHOT_PATH)
+                logger.info(f"💾 Снимок состояния записан в {SNAPSHOT_PATH}")
+            storage.close()
+
+def run_local_cluster(workers: int):
+    # Запускает узлы w0..wN-1 на портах PORT, PORT+1, ... с общей базой DB_PATH
+    nodes = ",".join(f"w{i}=http://127.0.0.1:{PORT + i}" for i in range(workers))
+    secret = CLUSTER_SECRET or secrets.token_urlsafe(32)
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            env={**os.environ, "CLUSTER_NODE_ID": f"w{i}", "CLUSTER_NODES": nodes, "CLUSTER_SECRET": secret,
+                 "PORT": str(PORT + i)}
+        )
+        for i in range(workers)
+    ]
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+def run_admin(args):
+    # Выгрузка и загрузка истории без запуска бота
+    path = args.export or args.import_path
+    write, read = EXPORT_FORMATS[args.format or export_format_of(path)]
+    storage.open(create_storage_backend())
+    try:
+        started = time.perf_counter()
+        if args.export:
+            with open(path, "wb") as out:
+                count = write(storage.iter_session_chunks(args.user), out)
+        else:
+            with open(path, "rb") as inp:
+                count = storage.import_chunks(read(inp))
+        action = "Выгружено" if args.export else "Загружено"
+        logger.info(f"{action} сессий: {count} за {time.perf_counter() - started:.2f} с")
+    finally:
+        storage.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бот осознанности")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--workers", type=int, default=0, help="запустить несколько процессов-узлов")
+    mode.add_argument("--export", metavar="PATH", help="выгрузить историю в файл (.csv или колоночный)")
+    mode.add_argument("--import", dest="import_path", metavar="PATH", help="загрузить историю из файла")
+    parser.add_argument("--user", type=int, help="только этот пользователь (для --export)")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), help="по умолчанию — по расширению файла")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        if args.export or args.import_path:
+            run_admin(args)
+        elif args.workers > 1:
+            run_local_cluster(args.workers)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
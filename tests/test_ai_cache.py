@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+import main
+
+KEY = ("как справиться с тревогой", "system", 0.6, 2000, "gpt://folder/yandexgpt-lite")
+
+
+def test_concurrent_identical_prompts_share_one_call():
+    cache = main.AIResponseCache()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "Дыши глубже"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_fetch(KEY, fetch) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["Дыши глубже"] * 5
+    assert len(calls) == 1
+    assert (cache.misses, cache.coalesced) == (1, 4)
+    assert asyncio.run(cache.get_or_fetch(KEY, fetch)) == "Дыши глубже"
+    assert (len(calls), cache.hits) == (1, 1)
+
+
+def test_cancelled_owner_fails_waiters_with_request_error():
+    cache = main.AIResponseCache()
+
+    async def fetch():
+        await asyncio.sleep(10)
+
+    async def scenario():
+        owner = asyncio.create_task(cache.get_or_fetch(KEY, fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_fetch(KEY, fetch))
+        await asyncio.sleep(0)
+        owner.cancel()
+        with pytest.raises(main.AIRequestError):
+            await waiter
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+
+    asyncio.run(scenario())
+    assert not cache._in_flight
+
+
+def test_empty_completion_is_not_cached():
+    cache = main.AIResponseCache()
+    answers = iter(["", "Ответ"])
+
+    async def fetch():
+        return next(answers)
+
+    assert asyncio.run(cache.get_or_fetch(KEY, fetch)) == ""
+    assert asyncio.run(cache.get_or_fetch(KEY, fetch)) == "Ответ"
+    assert cache.misses == 2
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    cache = main.AIResponseCache(ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache.put(KEY, "Ответ")
+
+    now[0] += 59
+    assert cache.get(KEY) == "Ответ"
+    now[0] += 2
+    assert cache.get(KEY) is None
+    assert cache.bytes == 0
+
+
+def test_byte_bound_evicts_least_recently_used():
+    cache = main.AIResponseCache(max_bytes=400)
+    keys = [(f"вопрос {i}",) + KEY[1:] for i in range(3)]
+    for key in keys:
+        cache.put(key, "о" * 50)  # 100 байт ответа и 14 байт ключа
+    cache.get(keys[0])
+    cache.put(("новый",) + KEY[1:], "о" * 50)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.bytes <= 400
+    cache.put(("огромный",) + KEY[1:], "о" * 500)
+    assert cache.get(("огромный",) + KEY[1:]) is None
+
+
+def test_empty_completion_gets_a_fallback_reply(monkeypatch):
+    monkeypatch.setattr(main, "YC_API_KEY", "key")
+    monkeypatch.setattr(main, "YC_FOLDER_ID", "folder")
+    monkeypatch.setattr(main, "ai_cache", main.AIResponseCache())
+
+    async def complete(payload):
+        return {"result": {"alternatives": [{"message": {"text": "  "}}]}}
+
+    monkeypatch.setattr(main.ai_client, "complete", complete)
+
+    assert asyncio.run(main.get_ai_response("Привет")) == main.AI_EMPTY_RESPONSE
@@ -0,0 +1,60 @@
+import asyncio
+
+import main
+
+
+async def serve(handler):
+    app = main.web.Application()
+    app.router.add_post("/completion", handler)
+    runner = main.web.AppRunner(app, shutdown_timeout=0.1)
+    await runner.setup()
+    site = main.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}/completion"
+
+
+def run_client(handler, monkeypatch, timeout: float):
+    monkeypatch.setattr(main, "AI_RETRY_BASE_SECONDS", 0.01)
+
+    async def scenario():
+        runner, url = await serve(handler)
+        client = main.YandexGPTClient(url, timeout=timeout, max_retries=2)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            return await client.complete({}), loop.time() - started, client
+        except main.AIRequestError:
+            return None, loop.time() - started, client
+        finally:
+            await client.close()
+            await runner.shutdown()
+            await runner.cleanup()
+
+    return asyncio.run(scenario())
+
+
+def test_timeouts_share_one_deadline_across_retries(monkeypatch):
+    async def hang(request):
+        await asyncio.sleep(2)
+        return main.web.json_response({})
+
+    data, elapsed, client = run_client(hang, monkeypatch, timeout=0.3)
+
+    assert data is None
+    assert elapsed < 0.5
+    assert client.errors["TimeoutError"] >= 1
+
+
+def test_server_errors_are_retried_within_the_deadline(monkeypatch):
+    attempts = []
+
+    async def flaky(request):
+        attempts.append(1)
+        if len(attempts) < 3:
+            return main.web.Response(status=503)
+        return main.web.json_response({"result": "ok"})
+
+    data, elapsed, client = run_client(flaky, monkeypatch, timeout=2)
+
+    assert data == {"result": "ok"}
+    assert (client.requests, client.retries) == (3, 2)
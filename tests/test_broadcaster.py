@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import main
+from bench import FakeBot
+
+
+def run_broadcast(bot: FakeBot, chats, **kwargs):
+    broadcaster = main.Broadcaster(bot, **kwargs)
+    return asyncio.run(broadcaster.broadcast((chat_id, "📨") for chat_id in chats))
+
+
+def test_blocked_chats_fail_and_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(main.random, "random", lambda: 0.0)  # пауза после обрыва сети — 0.5 с
+    bot = FakeBot(blocked_chats={3}, flood_every=4, retry_after=0.2, flaky_chats={5})
+
+    report = run_broadcast(bot, range(1, 9), concurrency=2, rate=1000, per_chat_interval=0, max_retries=3)
+
+    assert (report.total, report.sent, report.failed) == (8, 7, 1)
+    assert list(report.errors) == [3]
+    assert report.retries == len(bot.floods) + 1
+    assert sorted(chat_id for chat_id, *_ in bot.sent) == [1, 2, 4, 5, 6, 7, 8]
+
+
+def test_retry_after_pauses_every_worker():
+    bot = FakeBot(flood_every=3, retry_after=0.3)
+
+    report = run_broadcast(bot, range(1, 7), concurrency=3, rate=1000, per_chat_interval=0, max_retries=1)
+
+    assert report.sent == 6
+    flood_at = bot.floods[0]
+    assert all(sent_at - flood_at >= 0.29 for *_, sent_at in bot.sent if sent_at > flood_at)
+
+
+def test_rate_limit_paces_sends():
+    bot = FakeBot()
+    started = time.monotonic()
+
+    report = run_broadcast(bot, range(1, 41), concurrency=8, rate=50, per_chat_interval=0)
+
+    # Полный бак (50) уходит сразу, дальше не быстрее 50 сообщений/с
+    assert report.sent == 40
+    assert time.monotonic() - started < 0.5
+
+    bot = FakeBot()
+    started = time.monotonic()
+
+    report = run_broadcast(bot, range(1, 81), concurrency=8, rate=50, per_chat_interval=0)
+
+    assert report.sent == 80
+    assert time.monotonic() - started >= (80 - 50) / 50 * 0.9
+
+
+def test_per_chat_interval_spaces_messages_to_one_chat():
+    bot = FakeBot()
+
+    run_broadcast(bot, [7, 7, 7], concurrency=3, rate=1000, per_chat_interval=0.1)
+
+    times = [sent_at for *_, sent_at in bot.sent]
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import main
+from test_update_lanes import make_update
+
+
+def sync_once(monkeypatch, storage: main.DataStorage, cluster: main.Cluster) -> main.DeadlineScheduler:
+    monkeypatch.setattr(main, "storage", storage)
+    monkeypatch.setattr(main, "cluster", cluster)
+    monkeypatch.setattr(main, "CLUSTER_SYNC_SECONDS", 0.01)
+
+    async def scenario():
+        scheduler = main.DeadlineScheduler()
+        monkeypatch.setattr(main, "scheduler", scheduler)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(main.cluster_sync_loop(), 0.1)
+        return scheduler
+
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("is_leader", [True, False])
+def test_sync_takes_over_only_own_and_orphaned_workouts(tmp_path, monkeypatch, is_leader):
+    backend = main.SQLiteBackend(str(tmp_path / "bot.sqlite3"))
+    storage = main.DataStorage()
+    storage.open(backend, shared=True)
+    cluster = main.Cluster("w0", "w0=http://a,w1=http://b,w2=http://c", secret="s")
+    cluster.is_leader = is_leader
+    backend.try_acquire_lease("node:w0", "w0", 60)
+    backend.try_acquire_lease("node:w1", "w1", 60)  # у w2 пульса нет
+
+    users = {}  # узел -> пользователь
+    for user_id in range(1, 1000):
+        users.setdefault(cluster.ring.owner(user_id), user_id)
+    now = main.now_moscow()
+    for user_id in users.values():
+        storage.start_active_session(user_id, now)
+
+    scheduler = sync_once(monkeypatch, storage, cluster)
+
+    assert ("auto_finish", users["w0"]) in scheduler
+    assert ("auto_finish", users["w1"]) not in scheduler
+    assert (("auto_finish", users["w2"]) in scheduler) == is_leader
+    storage.close()
+
+
+def test_forward_gives_up_on_a_hung_owner():
+    async def scenario():
+        async def hang(request):
+            await asyncio.sleep(1)
+            return main.web.Response()
+
+        app = main.web.Application()
+        app.router.add_post(main.Cluster.FORWARD_PATH, hang)
+        runner = main.web.AppRunner(app)
+        await runner.setup()
+        site = main.web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        cluster = main.Cluster("w0", f"w0=http://127.0.0.1:1,w1=http://127.0.0.1:{port}", secret="s",
+                               forward_timeout=0.2)
+        await cluster.start(None)
+        user_id = next(u for u in range(1, 1000) if cluster.ring.owner(u) == "w1")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            handled = await cluster.forward(make_update(1, user_id))
+            elapsed = loop.time() - started
+        finally:
+            await cluster.close()
+            await runner.shutdown()
+            await runner.cleanup()
+        return handled, elapsed, cluster
+
+    handled, elapsed, cluster = asyncio.run(scenario())
+
+    assert handled and elapsed < 0.9
+    assert (cluster.forwarded, cluster.forward_failed) == (0, 1)
@@ -0,0 +1,70 @@
+import io
+
+import pytest
+
+import main
+
+ROWS = [
+    (1, "mindfulness", 1_700_000_000.0, None, "Без заметки"),
+    (1, "fitness", 1_700_000_060.5, 1800, "бег 🏃, «по парку»"),
+    (2, "fitness", 1_700_000_120.0, None, "йога\nс переносом строки"),
+    (-5, "mindfulness", 1_700_000_180.25, None, "Без заметки"),
+    (2, "fitness", 1_700_000_240.0, 0, ""),
+]
+CHUNKS = [ROWS[:2], ROWS[2:4], ROWS[4:]]
+
+
+def flatten(chunks) -> list:
+    return [row for rows in chunks for row in rows]
+
+
+def test_columnar_round_trip():
+    out = io.BytesIO()
+
+    assert main.write_columnar(iter(CHUNKS), out) == len(ROWS)
+    chunks = list(main.read_columnar(io.BytesIO(out.getvalue())))
+
+    assert [len(rows) for rows in chunks] == [2, 2, 1]
+    assert flatten(chunks) == ROWS
+
+
+def test_csv_round_trip_across_chunks():
+    out = io.BytesIO()
+
+    assert main.write_csv(iter(CHUNKS), out) == len(ROWS)
+    chunks = list(main.read_csv(io.BytesIO(out.getvalue()), chunk_size=2))
+
+    assert [len(rows) for rows in chunks] == [2, 2, 1]
+    assert flatten(chunks) == ROWS
+
+
+@pytest.mark.parametrize("cut", [3, 7, 20, -1])
+def test_truncated_columnar_file_raises(cut):
+    out = io.BytesIO()
+    main.write_columnar(iter(CHUNKS), out)
+
+    with pytest.raises(ValueError):
+        list(main.read_columnar(io.BytesIO(out.getvalue()[:cut])))
+
+
+def test_csv_with_foreign_header_or_kind_raises():
+    with pytest.raises(ValueError):
+        list(main.read_csv(io.BytesIO(b"a,b\n1,2\n")))
+    bad_kind = "user_id,kind,time,duration_seconds,note\n1,sleep,2024-01-01T00:00:00+03:00,,\n"
+    with pytest.raises(ValueError):
+        list(main.read_csv(io.BytesIO(bad_kind.encode("utf-8"))))
+
+
+def test_import_into_sqlite_then_export_again(tmp_path):
+    backend = main.SQLiteBackend(str(tmp_path / "bot.sqlite3"))
+    storage = main.DataStorage()
+    storage.open(backend)
+
+    assert storage.import_chunks(iter(CHUNKS)) == len(ROWS)
+    assert backend.user_version(1) == 1 and backend.user_version(2) == 2
+    exported = flatten(backend.iter_session_chunks(chunk_size=2))
+
+    assert sorted(exported) == sorted(ROWS)
+    storage.ensure_user(1)
+    assert [s["note"] for s in storage.fitness_sessions[1]] == ["бег 🏃, «по парку»"]
+    storage.close()
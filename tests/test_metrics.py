@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+import main
+
+
+def test_blocking_gauges_are_read_off_the_event_loop():
+    registry = main.MetricsRegistry()
+    threads = []
+
+    def read():
+        threads.append(threading.current_thread())
+        return 3
+
+    registry.gauge("bot_rows", "Строки в базе", read, blocking=True)
+    registry.gauge("bot_cheap", "Значение из памяти", lambda: 5)
+
+    text = asyncio.run(registry.collect())
+
+    assert "bot_rows 3" in text and "bot_cheap 5" in text
+    assert threads and threads[0] is not threading.main_thread()
+    assert "bot_rows 3" in registry.render()
+    assert len(threads) == 1
+
+
+def test_shared_counts_use_sql_count(tmp_path):
+    backend = main.SQLiteBackend(str(tmp_path / "bot.sqlite3"))
+    sessions = main.SharedActiveSessions(backend)
+    sessions[1] = main.now_moscow()
+    sessions[2] = main.now_moscow()
+
+    assert len(sessions) == backend.count_rows("active_sessions") == 2
+    backend.close()
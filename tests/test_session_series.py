@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+import main
+
+
+def test_span_and_total_duration_with_back_dated_inserts():
+    series = main.SessionSeries()
+    now = main.now_moscow()
+    for hours, duration in [(5, 600), (1, None), (3, 1200), (0, 300), (4, None)]:
+        series.append(now - timedelta(hours=hours), "бег", duration)
+
+    assert [s["duration_seconds"] for s in series] == [600, None, 1200, None, 300]
+    lo, hi = series.span(now - timedelta(hours=4, minutes=30))
+    assert (hi - lo, series.total_duration(lo, hi)) == (4, 1500)
+    lo, hi = series.span(now - timedelta(hours=6), now - timedelta(minutes=30))
+    assert (hi - lo, series.total_duration(lo, hi)) == (4, 1800)
+    assert series.total_duration(0, 0) == 0
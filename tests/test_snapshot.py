@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+import main
+
+
+def test_snapshot_round_trip_with_open_dialogs(tmp_path, storage):
+    path = str(tmp_path / "state.snapshot")
+    now = main.now_moscow()
+    storage.add_session("mindfulness", 1, {"time": now - timedelta(hours=1), "note": "дыхание"})
+    storage.add_session("fitness", 2, {"time": now, "note": "бег", "duration_seconds": 1800})
+    storage.start_active_session(3, now)
+    storage.user_states[1] = main.UserState(main.State.AI_PROMPT)
+    storage.user_states[2] = main.UserState(main.State.STAT_PERIOD, stat_category="fitness")
+    storage.user_states[4] = main.UserState(main.State.NOTE_INPUT, "mindfulness", now)
+
+    storage.save_snapshot(path)
+
+    restored = main.DataStorage()
+    assert restored.open(main.MemoryBackend(), snapshot_path=path)
+    assert [uid for uid, _ in restored.user_states.snapshot_items()] == [1, 2, 4]
+    assert restored.user_states[2].stat_category == "fitness"
+    assert restored.user_states[4].session_time == now
+    assert restored.active_fitness_sessions == {3: now}
+    assert restored.mindfulness_sessions[1].session(0)["note"] == "дыхание"
+    assert restored.fitness_sessions[2].session(0)["duration_seconds"] == 1800
+    today = main.ActivityCounters.day_of(now)
+    assert restored.counters.totals(2, today, today) == (0, 1, 1800)
+
+
+def test_snapshot_does_not_touch_dialog_order(tmp_path, storage):
+    for user_id in range(5):
+        storage.user_states[user_id] = main.UserState(main.State.AI_PROMPT)
+
+    storage.save_snapshot(str(tmp_path / "state.snapshot"))
+
+    assert list(storage.user_states) == [0, 1, 2, 3, 4]
@@ -0,0 +1,108 @@
+import asyncio
+import sqlite3
+from datetime import timedelta
+
+import pytest
+
+import main
+
+
+def test_appends_during_background_flush_are_not_lost(tmp_path):
+    backend = main.SQLiteBackend(str(tmp_path / "bot.sqlite3"), batch_size=50)
+
+    async def scenario():
+        now = main.now_moscow()
+        flushes = []
+        for i in range(2000):
+            backend.append_session("mindfulness", i % 10, {"time": now, "note": "Без заметки"})
+            if backend.needs_flush():
+                flushes.append(asyncio.create_task(backend.flush_async()))
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+        await asyncio.gather(*flushes)
+        await backend.flush_async()
+
+    asyncio.run(scenario())
+
+    assert backend.snapshot_marker()[1] == 2000
+    assert sum(backend.user_version(user_id) for user_id in range(10)) == 2000
+    backend.close()
+
+
+def test_ensure_user_async_loads_history_off_the_loop(tmp_path):
+    path = str(tmp_path / "bot.sqlite3")
+    now = main.now_moscow()
+    writer = main.DataStorage()
+    writer.open(main.SQLiteBackend(path))
+    for _ in range(3):
+        writer.add_session("fitness", 1, {"time": now, "note": "бег", "duration_seconds": 600})
+    writer.close()
+
+    storage = main.DataStorage()
+    storage.open(main.SQLiteBackend(path))
+    asyncio.run(storage.ensure_user_async(1))
+
+    assert len(storage.fitness_sessions[1]) == 3
+    storage.add_session("fitness", 1, {"time": now, "note": "бег", "duration_seconds": 600})
+    asyncio.run(storage.ensure_user_async(1))
+    assert len(storage.fitness_sessions[1]) == 4
+    storage.close()
+
+
+def test_flush_keeps_the_batch_while_the_database_is_busy(tmp_path):
+    path = str(tmp_path / "bot.sqlite3")
+    backend = main.SQLiteBackend(path)
+    backend._conn.execute("PRAGMA busy_timeout = 50")
+    other = sqlite3.connect(path, isolation_level=None)
+    now = main.now_moscow()
+    for _ in range(3):
+        backend.append_session("mindfulness", 1, {"time": now, "note": "Без заметки"})
+
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        backend.flush()
+    other.execute("ROLLBACK")
+    other.close()
+    backend.flush()
+
+    assert backend.snapshot_marker()[1] == 3
+    assert backend.user_version(1) == 3
+    backend.close()
+
+
+def test_day_totals_are_kept_in_sqlite_across_restarts(tmp_path):
+    path = str(tmp_path / "bot.sqlite3")
+    now = main.now_moscow()
+    today = main.ActivityCounters.day_of(now)
+    storage = main.DataStorage()
+    storage.open(main.SQLiteBackend(path))
+    storage.add_session("mindfulness", 1, {"time": now, "note": "Без заметки"})
+    storage.add_session("fitness", 1, {"time": now, "note": "бег", "duration_seconds": 600})
+    storage.add_session("fitness", 2, {"time": now, "note": "йога", "duration_seconds": None})
+    storage.close()
+
+    restarted = main.DataStorage()
+    restarted.open(main.SQLiteBackend(path))
+    restarted.backend.bulk_append([(3, "fitness", now.timestamp(), 1200, "плавание"),
+                                   (3, "fitness", (now - timedelta(days=30)).timestamp(), 900, "старое")])
+
+    assert not restarted.counters.days
+    assert asyncio.run(restarted.day_totals(today)) == {1: (1, 1, 600), 2: (0, 1, 0), 3: (0, 1, 1200)}
+    restarted.close()
+
+
+def test_existing_database_backfills_day_totals_once(tmp_path):
+    path = str(tmp_path / "bot.sqlite3")
+    now = main.now_moscow()
+    backend = main.SQLiteBackend(path)
+    backend.append_session("fitness", 1, {"time": now, "note": "бег", "duration_seconds": 300})
+    backend.close()
+    conn = sqlite3.connect(path)
+    conn.execute("DROP TABLE daily_counters")
+    conn.commit()
+    conn.close()
+
+    backend = main.SQLiteBackend(path)
+
+    assert backend.day_totals(main.ActivityCounters.day_of(now)) == {1: (0, 1, 300)}
+    backend.close()
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("note", ["🧘" * 400, "🧘_*" * 200, "я" * 1000])
+def test_stats_page_fits_telegram_limit_in_utf16_units(monkeypatch, storage, note):
+    monkeypatch.setattr(main, "storage", storage)
+    now = main.now_moscow()
+    for minutes in range(main.STATS_PAGE_SIZE + 2):
+        storage.add_session("fitness", 1, {"time": now - timedelta(minutes=minutes), "note": note,
+                                           "duration_seconds": 3600})
+    today = main.ActivityCounters.day_of(now)
+    first_day = today - main.ActivityCounters.KEEP_DAYS + 1
+    period_start = now - timedelta(days=main.ActivityCounters.KEEP_DAYS)
+
+    text, markup = main.render_statistics_page(1, "fitness", first_day, today, 0)
+    summary = main.format_statistics_summary("спорта", main.STATS_PAGE_SIZE + 2, 43200, period_start, now)
+
+    assert markup is not None
+    assert text.count("🔹") == main.STATS_PAGE_SIZE
+    assert main.telegram_len(summary + text) <= 4096
+
+
+def test_shorten_note_counts_astral_emoji_twice():
+    shortened = main.shorten_note("🧘" * 400)
+
+    assert shortened.endswith("…")
+    assert main.telegram_len(shortened) <= main.STATS_NOTE_MAX_CHARS
+    assert main.shorten_note("🧘" * 10) == "🧘" * 10
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import main
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, "user", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, "private"), from_user=user, text="✨ Я осознан!")
+    return Update(update_id, message=message)
+
+
+def test_queued_user_does_not_starve_others():
+    async def scenario():
+        processor = main.UserLaneUpdateProcessor(2)
+        finished = []
+
+        async def handler(update: Update, latency: float):
+            await asyncio.sleep(latency)
+            finished.append((update.effective_user.id, update.update_id))
+
+        busy = [processor.process_update(u, handler(u, 0.05)) for u in map(make_update, range(1, 6), [1] * 5)]
+        other = make_update(10, 2)
+        await asyncio.gather(*busy, processor.process_update(other, handler(other, 0)))
+        return processor, finished
+
+    processor, finished = asyncio.run(scenario())
+
+    assert finished[0] == (2, 10)
+    assert [update_id for user_id, update_id in finished if user_id == 1] == [1, 2, 3, 4, 5]
+    assert processor.active_lanes == 0
+
+
+class FakeApplication:
+    # Ровно то, чем пользуется UpdateIngress: бот для de_json, процессор и обработка обновления
+    def __init__(self, processor, latencies: dict):
+        self.bot = None
+        self.update_processor = processor
+        self.latencies = latencies
+        self.finished = []
+
+    async def process_update(self, update: Update):
+        await asyncio.sleep(self.latencies.get(update.effective_user.id, 0))
+        self.finished.append((update.effective_user.id, update.update_id, time.monotonic()))
+
+
+class FakeRequest:
+    def __init__(self, update: Update, secret: str):
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+        self._data = update.to_dict()
+
+    async def json(self):
+        return self._data
+
+
+def test_webhook_lane_waits_do_not_hold_other_users():
+    async def scenario():
+        app = FakeApplication(main.UserLaneUpdateProcessor(4), {1: 0.5})
+        ingress = main.UpdateIngress(app, max_pending=100, secret="s")
+        ingress.start()
+        started = time.monotonic()
+        for update_id in range(1, 7):
+            assert (await ingress.handle_webhook(FakeRequest(make_update(update_id, 1), "s"))).status == 200
+        await ingress.handle_webhook(FakeRequest(make_update(10, 2), "s"))
+        await asyncio.sleep(0.1)
+        other = [at - started for user_id, _, at in app.finished if user_id == 2]
+        await ingress.stop(0.01)
+        return other, ingress
+
+    other, ingress = asyncio.run(scenario())
+
+    assert other and other[0] < 0.1
+    assert ingress.metrics()["pending"] == 0
+
+
+def test_webhook_rejects_over_the_pending_limit_and_wrong_secret():
+    async def scenario():
+        app = FakeApplication(main.UserLaneUpdateProcessor(4), {1: 0.2})
+        ingress = main.UpdateIngress(app, max_pending=2, secret="s")
+        ingress.start()
+        statuses = [(await ingress.handle_webhook(FakeRequest(make_update(i, 1), "s"))).status for i in range(1, 4)]
+        statuses.append((await ingress.handle_webhook(FakeRequest(make_update(9, 2), "bad"))).status)
+        await ingress.stop(1)
+        return statuses, app
+
+    statuses, app = asyncio.run(scenario())
+
+    assert statuses == [200, 200, 503, 403]
+    assert [update_id for _, update_id, _ in app.finished] == [1, 2]
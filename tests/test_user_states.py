@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def storage(storage):
+    storage.user_states.max_entries = 1
+    return storage
+
+
+def test_evicted_mindfulness_mark_is_saved_without_note(storage):
+    now = main.now_moscow()
+    storage.user_states[1] = main.UserState(main.State.NOTE_CONFIRMATION, "mindfulness", now)
+
+    storage.user_states[2] = main.UserState(main.State.AI_PROMPT)
+
+    assert 1 not in storage.user_states
+    session = storage.mindfulness_sessions[1].session(0)
+    assert (session["time"], session["note"]) == (now, "Без заметки")
+    assert storage.user_states.consume_expired(1)
+
+
+def test_evicted_finished_workout_keeps_duration(storage):
+    now = main.now_moscow()
+    storage.user_states[1] = main.UserState(
+        main.State.NOTE_INPUT, "fitness", now - timedelta(minutes=30), timedelta(minutes=30)
+    )
+
+    storage.user_states[2] = main.UserState(main.State.AI_PROMPT)
+
+    session = storage.fitness_sessions[1].session(0)
+    assert session["note"] == "Без заметки"
+    assert session["duration_seconds"] == 1800
+
+
+def test_evicted_running_workout_is_not_saved(storage):
+    now = main.now_moscow()
+    storage.start_active_session(1, now)
+    storage.user_states[1] = main.UserState(main.State.NOTE_CONFIRMATION, "fitness", now)
+
+    storage.user_states[2] = main.UserState(main.State.AI_PROMPT)
+
+    assert 1 not in storage.fitness_sessions
+    assert storage.active_fitness_sessions == {1: now}
+
+
+def test_shared_ttl_sweep_saves_pending_session_once(tmp_path):
+    path = str(tmp_path / "bot.sqlite3")
+    storage, other = main.DataStorage(), main.DataStorage()
+    storage.open(main.SQLiteBackend(path), shared=True)
+    other.open(main.SQLiteBackend(path), shared=True)
+    now = main.now_moscow()
+    storage.user_states[1] = main.UserState(main.State.NOTE_CONFIRMATION, "mindfulness", now)
+
+    storage.user_states.ttl = other.user_states.ttl = -1
+    storage.user_states.sweep()
+    other.user_states.sweep()
+    storage.backend.flush()
+
+    assert 1 not in storage.user_states
+    assert len(storage.backend.load_user(1)["mindfulness"]) == 1
+    storage.close()
+    other.close()